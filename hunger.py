@@ -1,47 +1,92 @@
 from hungerDataStructs import *
+from hungerProfile import PhaseProfiler
 
-from datetime import datetime as dt, date
+from time import perf_counter
 import os
-from statistics import pstdev
-from numpy import percentile as pct, sqrt
+import io
+import json
+import tempfile
+from numpy import sqrt
+import numpy as np
+from random import Random
+from bisect import insort, bisect_left
 
 class Solver:
-    def __init__(self, metricID, numDist):
+    # Keep the full placement behind each failure fingerprint, and check it on every hit
+    checkCollisions = False
+    # Makes the store for failures - swap in something like lambda: BloomFailures(10**7) for long solves
+    failureStore = FailureSet
+    # Makes a profiler for the solve phases, like PhaseProfiler or lambda: PhaseProfiler(trace=True) - None to skip it
+    phaseProfiler = None
+
+    # Bumped whenever what goes into a snapshot changes - older snapshots won't load
+    snapshotVersion = 1
+    # Stands in for the distance to regions that can't be reached
+    unreachable = np.iinfo(np.int64).max
+
+    def __init__(self, metricID, numDist, scale=None, seed=None, starterChoices=1):
         Logger.initialize()
+        self.data = getDataset(scale)
+        # With a seed, ties are broken randomly - otherwise the solve is always the same. The first district starts at
+        # one of the starterChoices biggest regions, picked with the seed (the biggest, by default). Anything much
+        # past the biggest few, and the districts after it get boxed in and the solve thrashes
+        self.seed = seed
+        self.starterChoices = starterChoices
         self.reset(metricID, numDist)
 
     def __del__(self):
         Logger.cleanup()
 
-    def reset(self, metricID, numDist):
+    def reset(self, metricID, numDist, scale=None):
+        # Switch datasets, if we've been asked to
+        if scale:
+            self.data = getDataset(scale)
+        regionlist = self.data.regionlist
+
         # Enable MetricID to be set as a string or an index
         if isinstance(metricID, str):
             self.metricID = metricID
         elif isinstance(metricID, int):
-            self.metricID = allowed[metricID]
+            self.metricID = self.data.allowed[metricID]
+        # Where the metric is in each region's values
+        self.metricIndex = self.data.allowed.index(self.metricID)
         
         self.inProgress = False
 
         # We have three ways of tracking region state... sad but fast!
-        self.placements = { region: 0 for region in sorted(regionlist.values(), key=lambda region: region.code) }
-        self.placedRegions = []
-        self.unplacedRegions = { region: region for region in regionlist.values() }
+        # placement is an array of district indices (0 for unplaced) by region id, and placedRegions/unplacedRegions
+        # map id -> Region (placedRegions in the order they were placed)
+        self.placement = np.zeros(len(self.data.regions), dtype=np.int16)
+        self.placedRegions = {}
+        self.unplacedRegions = { region.id: region for region in regionlist.values() }
 
-        # A list of the unused districts, to make enclosure detection reasonably fast
-        self.unusedDistricts = list(self.__getUnusedDistrictsFor(list(regionlist.values())))
+        # The connected groups of unplaced regions, to make enclosure detection reasonably fast
+        self.unusedDistricts = ComponentTracker(regionlist.values())
 
         # This helps prevent us from retreading our failed past attempts
-        self.failures = set()
+        # Placements are fingerprinted with a Zobrist hash, which is kept up to date as regions are placed and unplaced
+        self.zobrist = Solver.__getZobristKeys(len(self.data.regions), numDist)
+        self.hash = 0
+        self.failures = type(self).failureStore()
+        self.collisions = 0
 
         # Logging helpers
         self.startTime = 0
         self.lastTime = 0
-        self.times = {}
-        self.occurred = {}
+        self.profiler = type(self).phaseProfiler() if type(self).phaseProfiler else None
+
+        # The best plan solve has seen - the most regions placed, then the lowest std dev - for when it runs out of time
+        self.bestPlacement = self.placement.copy()
+        self.bestPlaced = 0
+        self.bestStandardDev = float("inf")
         Logger.logDepth = ""
 
+        # Breaks ties between otherwise equal regions - all 0s without a seed, so the first one found wins
+        self.random = Random(self.seed)
+        self.tieBreak = [ 0 ] * len(self.data.regions) if self.seed is None else self.random.sample(range(len(self.data.regions)), len(self.data.regions))
+
         # Calculate the maximum district size
-        sumAll = sum(region.metrics[self.metricID] for region in regionlist.values())
+        sumAll = sum(region.values[self.metricIndex] for region in regionlist.values())
         if numDist > 1:
             # shorthands for mathematical clarity
             m = sumAll/numDist
@@ -74,7 +119,7 @@ class Solver:
             negMaxForHalfPercent = abs((-b-d)/(2*a))
 
             # Get the largest single region - we can't expect to make districts smaller than this!
-            maxRegionMetric = self.__getLargestUnplacedFor().metrics[self.metricID]
+            maxRegionMetric = self.__getLargestUnplacedFor().values[self.metricIndex]
 
             # Whichever solution is larger, or the largest single region if it's larger than the solution
             self.maxAcceptableMetric = max(posMaxForHalfPercent, negMaxForHalfPercent, maxRegionMetric)
@@ -83,35 +128,149 @@ class Solver:
             self.maxAcceptableMetric = sumAll
 
         # Create the districts
-        self.districts = [District(i+1, self.metricID, self.maxAcceptableMetric) for i in range(numDist)]
-
-    def __getstate__(self):
-        state = self.__dict__.copy()
-        state['placements'] = { region.code: placement for region, placement in self.placements.items() }
-        state['unplacedRegions'] = [ region.code for region in self.unplacedRegions ]
-        return state
-    
-    def __setstate__(self, newstate):
-        newstate['placements'] = { regionlist[code]: placement for code, placement in newstate['placements'].items() }
-        newstate['unplacedRegions'] = { regionlist[code]: regionlist[code] for code in newstate['unplacedRegions'] }
-        newstate['unusedDistricts'] = list(self.__getUnusedDistrictsFor(list(newstate['unplacedRegions'])))
-        self.__dict__.update(newstate)
+        self.districts = [District(i+1, self.metricIndex, self.maxAcceptableMetric) for i in range(numDist)]
+
+        # Running totals over the districts, kept up to date as regions are placed and unplaced
+        # The heap answers "which district is smallest", and the sums give the standard deviation without a scan
+        self.districtHeap = DistrictHeap(self.districts)
+        self.metricSum = 0
+        self.metricSquares = 0
+        self.overfull = 0
+
+        # The total hop distance from each district to every region, by district index then region id - adding or
+        # removing a region just adds or subtracts its row
+        self.distanceSums = np.zeros((numDist+1, len(self.data.regions)), dtype=np.int64)
+
+        # For seeding: the hops from each region to the nearest placed region (unreachable being the max int), and the
+        # metrics of the unplaced regions in sorted order. Unplacing can't undo a minimum, so it marks nearestPlaced
+        # stale, and it's rebuilt the next time it's needed
+        self.metricValues = self.data.columns[self.metricID]
+        self.unplacedMetrics = sorted(self.metricValues.tolist())
+        self.nearestPlaced = np.full(len(self.data.regions), Solver.unreachable, dtype=np.int64)
+        self.nearestIsStale = False
+
+        # How many of each region's neighbors are in each district, by region id then district index
+        self.neighborCounts = np.zeros((len(self.data.regions), numDist+1), dtype=np.int32)
+
+    # Snapshots -----------------------------------------------------------------------------------
+
+    def getSnapshot(self):
+        # Nearly everything follows from which regions were placed where, in the order they were placed - so that's
+        # what gets kept, along with the order of the unplaced regions (which breaks ties), the best plan, the failure
+        # fingerprints and the random state. It's an npz, with the rest in a small json header
+        order = np.fromiter(self.placedRegions, dtype=np.int32, count=len(self.placedRegions))
+        randomVersion, randomState, gauss = self.random.getstate()
+        header = { "version":         Solver.snapshotVersion,
+                   "scale":           self.data.scale,
+                   "metric":          self.metricID,
+                   "count":           len(self.districts),
+                   "seed":            self.seed,
+                   "starterChoices":  self.starterChoices,
+                   "elapsed":         self.getTimeSinceStarted() if self.startTime else None,
+                   "collisions":      self.collisions,
+                   "bestPlaced":      self.bestPlaced,
+                   "bestStandardDev": self.bestStandardDev,
+                   "randomVersion":   randomVersion,
+                   "gauss":           gauss }
+
+        snapshot = io.BytesIO()
+        np.savez(snapshot,
+                 header=np.frombuffer(json.dumps(header).encode(), dtype=np.uint8),
+                 order=order,
+                 districts=self.placement[order],
+                 unplaced=np.fromiter(self.unplacedRegions, dtype=np.int32, count=len(self.unplacedRegions)),
+                 best=self.bestPlacement,
+                 random=np.array(randomState, dtype=np.uint32),
+                 **self.failures.toArrays())
+        return snapshot.getvalue()
+
+    @classmethod
+    def fromSnapshot(cls, snapshot):
+        with np.load(io.BytesIO(snapshot)) as arrays:
+            arrays = dict(arrays)
+        header = json.loads(arrays.pop("header").tobytes())
+        if header["version"] != Solver.snapshotVersion:
+            raise ValueError("Snapshot is version {}, but this solver reads version {}".format(header["version"], Solver.snapshotVersion))
+
+        solver = cls(header["metric"], header["count"], header["scale"], seed=header["seed"], starterChoices=header["starterChoices"])
+        solver.__restore(header, arrays)
+        return solver
+
+    def __replay(self, regionIds, districtIndices):
+        # Placing them again rebuilds everything that follows from them. The nearest placed
+        # distances are left to be rebuilt in one go when they're next needed
+        self.nearestIsStale = True
+        for regionId, districtIndex in zip(regionIds, districtIndices):
+            self.__place(self.data.regions[regionId], self.districts[districtIndex - 1])
+
+    def __restore(self, header, arrays):
+        self.__replay(arrays["order"].tolist(), arrays["districts"].tolist())
+        self.unplacedRegions = { regionId: self.data.regions[regionId] for regionId in arrays["unplaced"].tolist() }
+
+        self.failures.fromArrays(arrays)
+        self.collisions = header["collisions"]
+        self.bestPlacement[:] = arrays["best"]
+        self.bestPlaced = header["bestPlaced"]
+        self.bestStandardDev = header["bestStandardDev"]
+        self.random.setstate((header["randomVersion"], tuple(arrays["random"].tolist()), header["gauss"]))
+
+        # Carry on the clock from where it was
+        if header["elapsed"] is not None:
+            self.lastTime = perf_counter()
+            self.startTime = self.lastTime - header["elapsed"]
+
+    def __reduce__(self):
+        # Pickle as a snapshot - much smaller than the whole state, and the other end rebuilds the rest
+        return (type(self).fromSnapshot, (self.getSnapshot(),))
+
+    def save(self, path):
+        # Written to a temp file of its own and swapped in, so dying partway through leaves the last snapshot alone,
+        # and solvers saving to the same path can't swap in each other's half-written ones
+        handle, tempPath = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path) or ".")
+        try:
+            with os.fdopen(handle, "wb") as snapshotFile:
+                snapshotFile.write(self.getSnapshot())
+            os.replace(tempPath, path)
+        except BaseException:
+            os.unlink(tempPath)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as snapshotFile:
+            return cls.fromSnapshot(snapshotFile.read())
 
     # External Getters ----------------------------------------------------------------------------
+
+    @property
+    def placements(self):
+        # Region -> district index, in code order
+        return self.__getPlacementsFor(self.placement)
+
+    @property
+    def bestPlacements(self):
+        # The same, for the best plan solve has seen
+        return self.__getPlacementsFor(self.bestPlacement)
+
+    def __getPlacementsFor(self, placement):
+        placement = placement.tolist()
+        return { region: placement[region.id] for region in sorted(self.data.regions, key=lambda region: region.code) }
     
     def isSolved(self):
-        return all(placement > 0 for placement in self.placements.values()) and all(district.metric <= self.maxAcceptableMetric for district in self.districts)
+        return len(self.unplacedRegions) == 0 and self.overfull == 0
 
     def getStandardDevAsPercent(self):
-        metrics = [ district.metric for district in self.districts ]
-        sumAll = sum(metrics)
-        return 0 if sumAll == 0 else 100*pstdev(metrics)/sumAll
+        if self.metricSum == 0:
+            return 0
+        # Population variance, from the running sums - all integers, so there's no rounding until the square root
+        numDist = len(self.districts)
+        return 100*(numDist*self.metricSquares - self.metricSum**2)**0.5/numDist/self.metricSum
 
     def getTimeSinceStarted(self):
         if self.startTime == 0:
             return -1
         else:
-            return (self.lastTime - self.startTime).total_seconds()
+            return self.lastTime - self.startTime
 
     def getEmptyDataFrame():
         return { new_list: [] for new_list in ["region","code","district","metric"] }
@@ -119,20 +278,22 @@ class Solver:
     def getDummyDataFrame():
         return { new_list: ["none"] for new_list in ["region","code","district","metric"] }
 
-    def getCurrentDataFrame(self):
-        result = Solver.getEmptyDataFrame()
+    def getCurrentDataFrame(self, best=False):
+        # Placed regions, grouped by district - from the best plan seen, if asked
+        return self.getDataFrameFor(self.bestPlacement if best else self.placement)
 
-        for district in self.districts:
-            for region in district.regions:
-                result["region"].append(region.name)
-                result["code"].append(region.code)
-                result["district"].append(str(district.index))
-                result["metric"].append(region.metrics[self.metricID])
+    def getDataFrameFor(self, placement):
+        # Any placement over this solver's regions, like the ones batch results carry
+        placed = np.flatnonzero(placement)
+        placed = placed[np.argsort(placement[placed], kind="stable")].tolist()
 
-        if len(result["region"]) == 0:
-            result = Solver.getDummyDataFrame()
+        if len(placed) == 0:
+            return Solver.getDummyDataFrame()
 
-        return result
+        return { "region":   [ self.data.names[regionId] for regionId in placed ],
+                 "code":     [ self.data.codes[regionId] for regionId in placed ],
+                 "district": placement[placed].astype(str).tolist(),
+                 "metric":   self.metricValues[placed].tolist() }
 
     def getStarters(self, doStatus = False):
         # Get the starter regions for all districts - this is mostly for logging!
@@ -145,33 +306,38 @@ class Solver:
     def printResult(self):
         for district in self.districts:
             print("District {} ({}):".format(district.index, district.metric))
-            print("|".join(sorted(region.code for region in district.regions)))
+            print("|".join(sorted(region.code for region in district.regions.values())))
             print()
 
         return self
 
     def printConcise(self):
-        placedRegions = sorted(self.placedRegions, key=lambda region: region.code)
+        placedRegions = sorted(self.placedRegions.values(), key=lambda region: region.code)
         formatstr = "|".join(["{:^" + str(len(placedRegions[0].code)) + "}"]*len(placedRegions))
         print(formatstr.format(*(region.code for region in placedRegions)))
-        print(formatstr.format(*(self.placements[region] for region in placedRegions)))
+        print(formatstr.format(*(int(self.placement[region.id]) for region in placedRegions)))
 
         return self
 
     def printSummary(self):
-        fmt = "\t{:>10}({}) took {:.3f}s ({:.3f}%, {} failures)"
+        fmt = "\t{:>10}({}) took {:.3f}s ({:.3f}%, {} failures, {:.1f}KB, {:.1f}% hits, {}/{} contiguity rebuilds)"
         print(fmt.format(self.metricID,
               len(self.districts),
               self.getTimeSinceStarted(),
               self.getStandardDevAsPercent(),
-              len(self.failures)))
+              len(self.failures),
+              self.failures.getBytesUsed()/1024,
+              100*self.failures.getHitRate(),
+              sum(district.articulationBuilds for district in self.districts),
+              sum(district.removeChecks for district in self.districts)))
 
         return self
 
     def __doStepLogging(self):
-        total = sum(self.times.values())
+        # Per-phase times, if we're profiling
+        timesToPrint = {} if not self.profiler else { key: self.profiler.getSeconds(key) for key in sorted(self.profiler.totals) }
+        total = sum(timesToPrint.values())
         total = 1 if total == 0 else total
-        timesToPrint = { key: time for key, time in sorted(self.times.items()) }
         result = []
 
         # Failure count
@@ -185,7 +351,7 @@ class Solver:
         # Times
         for key, time in timesToPrint.items():
             result.append(key)
-            result.append(self.occurred[key])
+            result.append(self.profiler.counts[key])
 
             percent = 100*time/total
             if percent > 70:
@@ -204,12 +370,13 @@ class Solver:
 
         # Progress bar
         # The number of available cells for progress bar
-        availCells = os.get_terminal_size().columns - numChars - 7
+        columns = os.get_terminal_size().columns
+        availCells = columns - numChars - 7
         # The number we'll actually use - closest 10, rounding down (no rounding if less than 10)
         numCells = availCells if availCells <= 10 else availCells - (availCells%10)
 
         if numCells > 5:
-            percent = 100*len(self.placedRegions)/len(self.placements)
+            percent = 100*len(self.placedRegions)/len(self.placement)
             if percent < 50:
                 progressColor = color.RED
             elif percent < 90:
@@ -220,7 +387,7 @@ class Solver:
             suffix = ""
         else:
             progressbar = ""
-            suffix = (os.get_terminal_size().columns - numChars-1)*" "
+            suffix = (columns - numChars-1)*" "
 
         # Put it all together!
         print(progressbar + resultStr + suffix, end="\r")
@@ -228,131 +395,129 @@ class Solver:
     # Setters -------------------------------------------------------------------------------------
 
     def __addToFailures(self):
-        self.failures.add(tuple(self.placements.values()))
+        self.failures.add(self.hash, self.placement.tobytes() if self.checkCollisions else None)
+
+    def __updateDistrictStats(self, district, oldMetric):
+        # Keep the heap and running sums in line with a district whose metric just changed
+        self.districtHeap.update(district)
+        self.metricSum += district.metric - oldMetric
+        self.metricSquares += district.metric**2 - oldMetric**2
+        self.overfull += int(district.metric > self.maxAcceptableMetric) - int(oldMetric > self.maxAcceptableMetric)
 
     def __place(self, region, district):
         # Add to the four different tracking methods (gross)
+        oldMetric = district.metric
         district.addRegion(region)
-        self.placedRegions.append(region)
-        self.unplacedRegions.pop(region)
-        self.placements[region] = district.index
-
-        # Look up which unused district this one is in
-        for uDistrict in self.unusedDistricts:
-            if region in uDistrict.regions:
-                isOnlyConnection = not uDistrict.canRemove(region)
-                uDistrict.removeRegion(region)
-
-                if len(uDistrict.regions) == 0:
-                    self.unusedDistricts.remove(uDistrict)
-                # If this is true, this region was the only thing holding two parts of the district together
-                # we have to regenerate new districts after removal, since it's (probably) been split
-                elif isOnlyConnection:
-                    self.unusedDistricts.remove(uDistrict)
-                    for newDistrict in self.__getUnusedDistrictsFor(uDistrict.regions):
-                        self.unusedDistricts.append(newDistrict)
-                break
+        self.__updateDistrictStats(district, oldMetric)
+        self.distanceSums[district.index] += self.data.distances.row(region.id)
+        self.neighborCounts[self.__getAdjIds(region), district.index] += 1
+        self.unplacedMetrics.pop(bisect_left(self.unplacedMetrics, region.values[self.metricIndex]))
+        self.placedRegions[region.id] = region
+        self.unplacedRegions.pop(region.id)
+        self.placement[region.id] = district.index
+        self.hash ^= self.zobrist[region.id][district.index]
+
+        # Bring the nearest placed distances up to date, unless they're getting rebuilt anyway
+        if not self.nearestIsStale:
+            self.__addToNearestPlaced(region)
+
+        # Take it out of its unused district, which splits it up if this was holding it together
+        self.unusedDistricts.remove(region)
+
+    def __addToNearestPlaced(self, region):
+        row = self.data.distances.row(region.id).astype(np.int64)
+        row[row == 0] = Solver.unreachable
+        np.minimum(self.nearestPlaced, row, out=self.nearestPlaced)
 
     def __unplace(self, region = None):
         # Remove from the four different tracking methods (gross)
-        if region:
-            self.placedRegions.remove(region)
-        else:
-            region = self.placedRegions.pop()
-        self.unplacedRegions[region] = region
-        district = self.districts[self.placements[region]-1]
+        if region is None:
+            region = next(reversed(self.placedRegions.values()))
+        self.placedRegions.pop(region.id)
+        self.unplacedRegions[region.id] = region
+        district = self.districts[self.placement[region.id]-1]
+        oldMetric = district.metric
         district.removeRegion(region)
-        self.placements[region.code] = 0
-
-        adjDists = [ uDistrict for uDistrict in self.unusedDistricts if region.code in uDistrict.adj ]
-        # This is adjacent to exactly one unused district - just add to that one
-        if len(adjDists) == 1:
-            adjDists[0].addRegion(region)
-        # This is not adjacent to any unused districts - it's a new, lonely district all on its lonesome
-        elif len(adjDists) == 0:
-            uDistrict = District(0)
-            uDistrict.addRegion(region)
-            self.unusedDistricts.append(uDistrict)
-        else:
-            # This is adjacent to multiple unused districts - we can merge them!
-            adjDists.sort(key=lambda uDist: len(uDist.regions))
-            uDistrict = adjDists.pop()
-            uDistrict.addRegion(region)
+        self.__updateDistrictStats(district, oldMetric)
+        self.distanceSums[district.index] -= self.data.distances.row(region.id)
+        self.neighborCounts[self.__getAdjIds(region), district.index] -= 1
+        insort(self.unplacedMetrics, region.values[self.metricIndex])
+        self.hash ^= self.zobrist[region.id][district.index]
+        self.placement[region.id] = 0
+        self.nearestIsStale = True
 
-            # Merge the regions from all adjacent districts into this district
-            for adjRegion in (region for regions in (uDistrict.regions for uDistrict in adjDists) for region in regions):
-                uDistrict.addRegion(adjRegion)
-
-            # Remove the now-superfluous districts
-            self.unusedDistricts = [uDistrict for uDistrict in self.unusedDistricts if uDistrict not in adjDists]
+        # Put it back with the unused regions, merging any unused districts it joins up
+        self.unusedDistricts.add(region)
 
         return region, district
 
     def __unplaceSmarter(self):
-        district = min(self.districts)
+        district = self.districtHeap.min()
 
         # Get the difference between the number of neighbors in this and the number of neighbors in the current district
-        diffCalc = lambda region: district.adj.get(region, 0) - sum(1 for adjCode in region.adj if adjCode in self.districts[self.placements[region]-1].regions)
+        diffCalc = lambda region: int(self.neighborCounts[region.id, district.index] - self.neighborCounts[region.id, self.placement[region.id]])
 
         # Get the max placed region adjacent to this district which is eligible to be added and at least as connected to this as it is to the district it's leaving
-        while not (region := max((region for region in self.placedRegions if self.__canAddToDistrict(region, district) and self.districts[self.placements[region]-1].canRemove(region)),
-                                 key=lambda region: (district.adj.get(region, 0), diffCalc(region), region.metrics[self.metricID]),
+        while not (region := max((region for region in self.__getBorderRegions(district) if self.__canAddToDistrict(region, district) and self.districts[self.placement[region.id]-1].canRemove(region)),
+                                 key=lambda region: (district.adj.get(region.id, 0), diffCalc(region), region.values[self.metricIndex], self.tieBreak[region.id]),
                                  default=False)):
             # While we can't find one, just unplace the last placed region
             self.__unplace()
-            district = min(self.districts)
+            district = self.districtHeap.min()
 
         self.__unplace(region)
 
         return region, district
 
-    def __updateTime(self, tag = None):
-        # Initialize the start time, if we have to
-        if self.startTime == 0:
-            self.startTime = dt.now()
-
-        # Initialize the last time if no tag was provided
-        if not tag:
-            self.lastTime = dt.now()
-        else:
-            newTime = dt.now()
-            self.times[tag] = self.times.get(tag, 0) + (newTime - self.lastTime).total_seconds()
-            self.occurred[tag] = self.occurred.get(tag, 0) + 1
-            self.lastTime = newTime
+    def __recordBest(self):
+        placed = len(self.placedRegions)
+        standardDev = self.getStandardDevAsPercent()
+        if placed > self.bestPlaced or (placed == self.bestPlaced and standardDev < self.bestStandardDev):
+            self.bestPlacement[:] = self.placement
+            self.bestPlaced = placed
+            self.bestStandardDev = standardDev
 
     def __addUnusedDistricts(self):
-        # Copy the unused districts, since we remove things while traversing
-        tempUnused = self.unusedDistricts[:]
-        for uDistrict in tempUnused:
-            adjacentSet = set(uDistrict.adj)
-            for district in self.districts:
-                # If this unused district's adjacent regions are all in district, AND this unused district has some adjacent regions (sorry Alaska), add them all!
-                if adjacentSet and adjacentSet <= district.regions:
-                    regionsToPlace = []
-                    # Check if these regions can be added to the district in question
-                    # We already know they are adjacent, so we only need to check if this is on the failures list
-                    for region in uDistrict.regions:
-                        if not self.__canAddToDistrict(region, district, onlyFailures=True):
-                            return False
-                        regionsToPlace.append(region)
-
-                    Logger.s("!", district.index, "enclosed {} regions:".format(len(regionsToPlace)), regionsToPlace)
-                    for region in regionsToPlace:
-                        self.__place(region, district)
-
-                    # We have placed all the items from this district - the last __place removed it from the list
-                    break
+        # Iterating gives a copy of the unused districts, since we remove things while traversing
+        for uDistrict in self.unusedDistricts:
+            # If this unused district's adjacent regions are all in one district, AND this unused district has some adjacent regions (sorry Alaska), add them all!
+            if uDistrict.adj and len(enclosing := { self.placement[adjId] for adjId in uDistrict.adj }) == 1:
+                district = self.districts[enclosing.pop()-1]
+                regionsToPlace = []
+                # Check if these regions can be added to the district in question
+                # We already know they are adjacent, so we only need to check if this is on the failures list
+                for region in uDistrict.regions.values():
+                    if not self.__canAddToDistrict(region, district, onlyFailures=True):
+                        return False
+                    regionsToPlace.append(region)
+
+                Logger.s("!", district.index, "enclosed {} regions:".format(len(regionsToPlace)), regionsToPlace)
+                for region in regionsToPlace:
+                    self.__place(region, district)
 
         return True
 
     # Internal getters ----------------------------------------------------------------------------
 
-    def __isInDisconnectedDistrict(self, region):
-        for district in (district for district in self.unusedDistricts if len(district.adj) == 0):
-            if region in district.regions:
-                return True
+    def __getZobristKeys(numRegions, numDist):
+        # A random 64-bit key for each region in each district - 0 for unplaced, so those don't affect the hash
+        # The seed is fixed so that fingerprints mean the same thing in every process
+        keyGen = Random(numDist)
+        return [ [ 0 ] + [ keyGen.getrandbits(64) for _ in range(numDist) ] for _ in range(numRegions) ]
 
-        return False
+    def __getAdjIds(self, region):
+        # The region's neighbors as an array, straight out of the dataset's adjacency
+        return self.data.indices[self.data.indptr[region.id]:self.data.indptr[region.id+1]]
+
+    def __getBorderRegions(self, district):
+        # The placed regions which could be moved into the district - only those on its border, unless it's empty
+        if len(district.adj) == 0:
+            return self.placedRegions.values()
+        return [ self.data.regions[regionId] for regionId in district.adj if self.placement[regionId] > 0 ]
+
+    def __isInDisconnectedDistrict(self, region):
+        uDistrict = self.unusedDistricts.getComponent(region.id)
+        return uDistrict is not None and len(uDistrict.adj) == 0
 
     def __canAddToDistrict(self, region, district, onlyFailures=False, allowDisconnected=True):
         # If we aren't only checking failures, confirm that:
@@ -366,89 +531,152 @@ class Solver:
             return True
 
         # Check if the state post-placement has been tried and failed before
-        priorIndex = self.placements[region]
-        self.placements[region] = district.index
-        isFailure = tuple(self.placements.values()) in self.failures
-        self.placements[region] = priorIndex
-        return not isFailure
+        keys = self.zobrist[region.id]
+        newHash = self.hash ^ keys[self.placement[region.id]] ^ keys[district.index]
+        if newHash not in self.failures:
+            return True
+
+        # Make sure it's not just a hash collision
+        if self.checkCollisions and (failedPlacement := self.failures.getPlacement(newHash)) is not None:
+            placement = self.placement.copy()
+            placement[region.id] = district.index
+            if failedPlacement != placement.tobytes():
+                self.collisions += 1
+                return True
+        return False
+
+    def __getDistanceScores(self, district):
+        # The total distance from the district to every region
+        if len(district.regions) == 0:
+            return None
+        return self.distanceSums[district.index]
 
-    def __getDistanceScore(self, region, district):
-        distances = [ region.distances.get(inRegion, 0) for inRegion in district.regions ]
-        return -sum(distances) if distances else 1
+    def __getDistanceScore(self, region, scores):
+        return 1 if scores is None else -int(scores[region.id])
 
     def __getLargestUnplacedFor(self, district=None):
         if district==None:
             # Gets the biggest unplaced region, no other criteria
-            return max(self.unplacedRegions,
-                       key=lambda region: region.metrics[self.metricID],
+            return max(self.unplacedRegions.values(),
+                       key=lambda region: (region.values[self.metricIndex], self.tieBreak[region.id]),
                        default=False)
         else:
             # True if there are any non-placed adjacent districts
-            anyAdjacent = any(self.placements[adjCode] <= 0 for adjCode in district.adj)
+            anyAdjacent = any(self.placement[adjId] <= 0 for adjId in district.adj)
+            scores = self.__getDistanceScores(district)
             # Get the largest unplaced region which can be added to this district, keyed first on closest region and second on metric size
-            return max((region for region in self.unplacedRegions if self.__canAddToDistrict(region, district, allowDisconnected=not anyAdjacent)),
-                       key=lambda region: (self.__getDistanceScore(region, district),
-                                          region.metrics[self.metricID]),
+            return max((region for region in self.unplacedRegions.values() if self.__canAddToDistrict(region, district, allowDisconnected=not anyAdjacent)),
+                       key=lambda region: (self.__getDistanceScore(region, scores),
+                                          region.values[self.metricIndex],
+                                          self.tieBreak[region.id]),
                        default=False)
 
-    def __getNextStarter(self):
-        # Get the distances
-        minDistances = {}
-        metrics = [region.metrics[self.metricID] for region in self.unplacedRegions]
+    def __getNearestPlaced(self):
+        # The distance from each region to the closest placed region it can reach
+        if self.nearestIsStale:
+            self.nearestPlaced.fill(Solver.unreachable)
+            for region in self.placedRegions.values():
+                self.__addToNearestPlaced(region)
+            self.nearestIsStale = False
+        return self.nearestPlaced
 
+    def __getNextStarter(self):
         # If there are no regions to place, return False
-        if len(metrics) == 0:
+        if len(self.unplacedRegions) == 0:
             return False
 
-        percentile = pct(metrics, 50)
-        district = min(self.districts)
-        for region in (region for region in self.unplacedRegions if region.metrics[self.metricID] >= percentile and self.__canAddToDistrict(region, district)):
-            minDistances[region] = min((tuple for tuple in region.distances.items() if tuple[0] in self.placedRegions),
-                                        key=lambda item: item[1],
-                                        default=("", float("-inf")))
+        # Only look at regions at least as big as the median unplaced region
+        median = self.unplacedMetrics[len(self.unplacedMetrics)//2]
+
+        # If nothing has been placed, nothing is reachable - just get the biggest unused region (or one of the biggest)
+        if len(self.placedRegions) == 0:
+            if self.starterChoices <= 1:
+                return self.__getLargestUnplacedFor()
+            return self.random.choice(sorted(self.unplacedRegions.values(), reverse=True,
+                                             key=lambda region: (region.values[self.metricIndex], self.tieBreak[region.id]))[:self.starterChoices])
+        nearest = self.__getNearestPlaced()
+        candidates = np.flatnonzero((self.placement == 0) & (self.metricValues >= median) & (nearest != Solver.unreachable))
+
+        # Furthest from everything placed first, then largest - take the first of those we're allowed to add
+        district = self.districtHeap.min()
+        tieBreak = [ self.tieBreak[regionId] for regionId in candidates.tolist() ]
+        for regionId in candidates[np.lexsort((tieBreak, -self.metricValues[candidates], -nearest[candidates]))].tolist():
+            region = self.data.regions[regionId]
+            if self.__canAddToDistrict(region, district):
+                return region
 
         # If nothing is reachable, just get the biggest unused region
-        if all(distance[1] == float("-inf") for distance in minDistances.values()):
-            return self.__getLargestUnplacedFor()
+        return self.__getLargestUnplacedFor()
 
-        # If we can reach some items, get those items!
-        else:
-            return max(minDistances, key=lambda region: (minDistances[region][1], region.metrics[self.metricID]), default=False)
+    # Refinement ----------------------------------------------------------------------------------
 
-    def __getUnusedDistrictsFor(self, regionsToBePlaced):
-        # Group the provided regions into districts
-        while seedRegion := next(iter(regionsToBePlaced), False):
-            unusedDistrict = District(0)
-            unusedDistrict.addRegion(seedRegion)
-            regionsToBePlaced.remove(seedRegion)
+    def setPlacement(self, placement):
+        # Start from a plan (district index by region id, 0 for unplaced) instead of from nothing - like one projected
+        # down from a coarser map. Meant for a fresh solver
+        placement = np.asarray(placement)
+        regionIds = np.flatnonzero(placement)
+        self.lastTime = perf_counter()
+        if self.startTime == 0:
+            self.startTime = self.lastTime
+        self.__replay(regionIds.tolist(), placement[regionIds].tolist())
+        self.__recordBest()
+        return self
 
-            while adjRegion := next((regionlist[code] for code in unusedDistrict.adj if code in regionsToBePlaced), False):
-                unusedDistrict.addRegion(adjRegion)
-                regionsToBePlaced.remove(adjRegion)
+    def refine(self, maxMoves=None):
+        # Moves regions on the borders between districts into smaller neighboring districts, the biggest improvement
+        # to the standard deviation first, for as long as there's one to be had. Only regions their district can
+        # spare without splitting up get moved, so every district stays in one piece
+        regionIds = np.arange(len(self.placement))
+        values = self.metricValues.astype(np.float64)
+        moves = 0
+        while maxMoves is None or moves < maxMoves:
+            metrics = np.array([ 0 ] + [ district.metric for district in self.districts ], dtype=np.float64)
+
+            # Moving v from a district at a to one at b changes the sum of squares by -2v(a - b - v)
+            gains = values[:, None] * (metrics[self.placement][:, None] - metrics[None, :] - values[:, None])
+            movable = (self.neighborCounts > 0) & (self.placement[:, None] > 0)
+            movable[:, 0] = False
+            movable[regionIds, self.placement] = False
+            gains[~movable] = 0
+
+            candidates = np.flatnonzero(gains > 0)
+            for candidate in candidates[np.argsort(-gains.flat[candidates], kind="stable")].tolist():
+                region = self.data.regions[candidate // gains.shape[1]]
+                source = self.districts[self.placement[region.id] - 1]
+                if len(source.regions) > 1 and source.canRemove(region):
+                    self.__unplace(region)
+                    self.__place(region, self.districts[candidate % gains.shape[1] - 1])
+                    moves += 1
+                    break
+            else:
+                break
 
-            yield unusedDistrict
+        self.lastTime = perf_counter()
+        self.__recordBest()
+        return self
 
     # Solve it ------------------------------------------------------------------------------------
 
     def getNextRegion(self):
-        self.__updateTime()
+        profiler = self.profiler
+        if profiler:    profiler.start()
 
         # get the smallest district
-        district = min(self.districts)
+        district = self.districtHeap.min()
 
-        self.__updateTime("getMinDistrict")
+        if profiler:    profiler.mark("getMinDistrict")
 
         # seed - there are no adjacent regions available
         if len(district.adj) == 0 and (region := self.__getNextStarter()):
-            self.__updateTime("getSeed")
+            if profiler:    profiler.mark("getSeed")
             return region, district
         # largest adjacent region, or largest neighborless region
         elif region := self.__getLargestUnplacedFor(district):
-            self.__updateTime("getUnplaced")
+            if profiler:    profiler.mark("getUnplaced")
             return region, district
         # else step backwards until we find something we can add to something else!
         else:
-            self.__updateTime("selectFailed")
+            if profiler:    profiler.mark("selectFailed")
             # Whatever led us to this point failed us - record the failure
             self.__addToFailures()
             return False
@@ -460,43 +688,65 @@ class Solver:
 
         self.inProgress = True
 
-        self.__updateTime()
+        self.lastTime = perf_counter()
+        if self.startTime == 0:
+            self.startTime = self.lastTime
 
         # Don't perform this if it's solved
         if self.isSolved():
             return
 
+        profiler = self.profiler
+
         # If we can't place something...
         if not (tuple := self.getNextRegion()):
             # Unplace the previous one, and get the next region!
-            self.__updateTime()
+            if profiler:    profiler.start()
             tuple = self.__unplaceSmarter()
-            self.__updateTime("unplace")
+            if profiler:    profiler.mark("unplace")
 
         self.__place(*tuple)
 
-        self.__updateTime("place")
+        if profiler:    profiler.mark("place")
 
         # If all the districts have something adjacent to them, check for enclosed regions
         if all(len(district.adj) > 0 for district in self.districts) and not self.isSolved():
             if not self.__addUnusedDistricts():
                 # Whatever led us to this point failed us - record the failure
                 self.__addToFailures()
-            self.__updateTime("checkUnused")
+            if profiler:    profiler.mark("checkUnused")
+
+        self.lastTime = perf_counter()
 
         # Do the logging for this step
         if doStatus:    self.__doStepLogging()
 
         self.inProgress = False
 
-    def solve(self, doStatus = False, doLogging = False):
+    def solve(self, doStatus = False, doLogging = False, timeBudget = None, maxSteps = None, checkpointPath = None, checkpointInterval = 60):
+        # Solves until it's done, or until timeBudget seconds or maxSteps steps have gone by - whichever comes first
+        # If it runs out, the best plan it saw is in bestPlacements and getCurrentDataFrame(best=True)
+        # With a checkpointPath, it saves itself there every checkpointInterval seconds and when it stops - Solver.load
+        # picks up where it left off
         Logger.doLogging = doLogging
         # Don't show the progress bar if logging is enabled
         if doLogging:   doStatus = False
 
+        deadline = None if timeBudget is None else perf_counter() + timeBudget
+        nextCheckpoint = perf_counter() + checkpointInterval
+        steps = 0
         while not self.isSolved():
+            if (maxSteps is not None and steps >= maxSteps) or (deadline is not None and perf_counter() >= deadline):
+                break
             self.doStep(doStatus)
+            self.__recordBest()
+            steps += 1
+
+            if checkpointPath and perf_counter() >= nextCheckpoint:
+                self.save(checkpointPath)
+                nextCheckpoint = perf_counter() + checkpointInterval
 
+        if checkpointPath:  self.save(checkpointPath)
         if doStatus:    print()
 
         return self
\ No newline at end of file
@@ -0,0 +1,69 @@
+# Batch solving
+#
+# For sweeping lots of (metric, count) pairs at once. Only small job specs go out to the workers, which attach to the
+# datasets the parent has published in shared memory (see hungerShared.py) and build their own solvers, and only small
+# summaries come back - never whole solvers. Results are yielded as they finish, so the caller can start on them while
+# the rest are still going.
+
+import hunger as h
+import hungerShared
+from multiprocessing import Pool, cpu_count
+
+def getSweepJobs(scale=None, counts=range(2, 11), **options):
+    # Every allowed metric at every count, with the same options for each
+    return [ dict(metric=metric, count=count, scale=scale, **options) for metric in h.getDataset(scale).allowed for count in counts ]
+
+def solveJob(job):
+    # A job is (metric, count), or a dict with metric and count plus any of scale, seed, timeBudget and maxSteps
+    if not isinstance(job, dict):
+        job = dict(metric=job[0], count=job[1])
+    solver = h.Solver(job["metric"], job["count"], job.get("scale"), seed=job.get("seed"))
+    solver.solve(timeBudget=job.get("timeBudget"), maxSteps=job.get("maxSteps"))
+
+    return { "metric":   solver.metricID,
+             "count":    job["count"],
+             "scale":    solver.data.scale,
+             "seed":     job.get("seed"),
+             "solved":   solver.isSolved(),
+             "time":     solver.getTimeSinceStarted(),
+             "stddev":   solver.getStandardDevAsPercent(),
+             "failures": len(solver.failures),
+             # District index by region id, as int16 bytes - np.frombuffer(placement, dtype=np.int16) to read it. This is
+             # the best plan seen, which is the solution if it solved
+             "placement": solver.bestPlacement.tobytes() }
+
+def solveBatch(jobs, workers=None):
+    # Yields a summary for each job, in the order they finish
+    jobs = list(jobs)
+    scales = { (job.get("scale") if isinstance(job, dict) else None) or h.scale for job in jobs }
+
+    # Share the datasets with the workers, and take down whatever we put up once we're done
+    published = [ scale for scale in scales if scale not in hungerShared.blocks ]
+    handles = [ hungerShared.publish(scale) for scale in scales ]
+    try:
+        with Pool(workers or cpu_count(), initializer=hungerShared.attachAll, initargs=(handles,)) as pool:
+            yield from pool.imap_unordered(solveJob, jobs)
+    finally:
+        for scale in published:
+            hungerShared.unpublish(scale)
+
+def printSummary(result):
+    # Like Solver.printSummary, for a batch result
+    fmt = "\t{:>10}({}) took {:.3f}s ({:.3f}%, {} failures){}"
+    print(fmt.format(result["metric"],
+          result["count"],
+          result["time"],
+          result["stddev"],
+          result["failures"],
+          "" if result["solved"] else " - out of time"))
+
+if __name__ == '__main__':
+    import sys
+    from time import perf_counter
+
+    scale = sys.argv[1] if len(sys.argv) > 1 else None
+    timeBudget = float(sys.argv[2]) if len(sys.argv) > 2 else 30
+    startTime = perf_counter()
+    for result in solveBatch(getSweepJobs(scale, timeBudget=timeBudget)):
+        printSummary(result)
+    print("Swept {} in {:.3f}s".format(scale or h.scale, perf_counter() - startTime))
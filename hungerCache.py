@@ -0,0 +1,77 @@
+# Precompiled dataset cache
+#
+# Parsing the tsv/csv assets (and importing the giant name_to_abbrev dicts) is slow, and every worker process pays for
+# it on import. This compiles each scale into a single .npz next to its assets, which loads in a few milliseconds.
+# The cache remembers the size and mtime of every source file it was built from, so editing any of them (or bumping
+# the version below) makes it stale, and hungerDataStructs falls back to the sources and rebuilds it.
+#
+# Distances aren't in here - they live in their own memory-mappable file (see hungerDistances.py).
+
+import numpy as np
+import os
+import tempfile
+from zipfile import BadZipFile
+
+CACHE_VERSION = 2
+
+sourceFiles = ["data.tsv", "adjacency.csv", "name_to_abbrev.py"]
+
+def getCachePath(scale):
+    return "assets/" + scale + "/dataset.npz"
+
+def getSourceStamps(scale):
+    # (size, mtime) for each source file - missing files get (-1, -1) so that creating them later invalidates the cache
+    stamps = []
+    for filename in sourceFiles:
+        try:
+            stat = os.stat("assets/" + scale + "/" + filename)
+            stamps.append((stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            stamps.append((-1, -1))
+    return np.array(stamps, dtype=np.int64)
+
+def save(scale, arrays):
+    # arrays is a dict with:
+    #   codes, names        - the region codes and names, in file order
+    #   metrics, values     - the metric names, and an int64 (region x metric) table of their values
+    #   indptr, indices     - the adjacency list in CSR form, indexing into codes
+    path = getCachePath(scale)
+    # Each writer gets its own temp file (pool children can all cold-start at once), which is swapped in all at once
+    # so a concurrent reader never sees half a file
+    handle, tempPath = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(handle, "wb") as tempFile:
+            np.savez(tempFile, version=CACHE_VERSION, stamps=getSourceStamps(scale), **arrays)
+        os.replace(tempPath, path)
+    except BaseException:
+        os.unlink(tempPath)
+        raise
+
+def load(scale):
+    # Returns the cached arrays, or None if the cache is missing, from another version, or older than its sources
+    try:
+        with np.load(getCachePath(scale), allow_pickle=False) as cache:
+            if int(cache["version"]) != CACHE_VERSION or not np.array_equal(cache["stamps"], getSourceStamps(scale)):
+                return None
+            arrays = { key: cache[key] for key in cache.files if key not in ["version", "stamps"] }
+    except (OSError, KeyError, ValueError, BadZipFile):
+        # Truncated or half-written files included - they just get rebuilt
+        return None
+
+    return arrays
+
+def build(scale):
+    # Force a rebuild from the source files
+    import hungerDataStructs as ds
+    arrays = ds.readSources(scale)
+    save(scale, arrays)
+    return arrays
+
+if __name__ == '__main__':
+    import sys
+    from datetime import datetime as dt
+
+    for scale in sys.argv[1:] or ["states"]:
+        startTime = dt.now()
+        arrays = build(scale)
+        print("Compiled {} ({} regions) to {} in {:.3f}s".format(scale, len(arrays["codes"]), getCachePath(scale), (dt.now() - startTime).total_seconds()))
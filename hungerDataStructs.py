@@ -1,6 +1,5 @@
 # Logging
 from colorama import Fore as color, Style, init, deinit
-from multiprocessing import Manager
 
 class Logger:
     doLogging = False
@@ -42,6 +41,292 @@ class Logger:
 # The data structures
 
 class District:
+    # Regions are tracked by their integer id: regions maps id -> Region, and adj maps the id of each neighboring
+    # region (not in the district) -> how many regions in the district it touches
+    # metricIndex is the position of the metric being balanced in each region's values
+    __slots__ = ("regions", "adj", "metric", "index", "remainingOverhead", "metricIndex",
+                 "articulationPoints", "articulationBuilds", "removeChecks")
+
+    def __init__(self, index, metricIndex=None, maxAcceptable=float("inf")):
+        self.regions = {}
+        self.adj = {}
+        self.metric = 0
+        self.index = index
+        self.remainingOverhead = maxAcceptable
+        self.metricIndex = metricIndex
+        # The regions holding this district together (ids) - worked out when canRemove needs them, and thrown away
+        # whenever the district changes
+        self.articulationPoints = None
+        self.articulationBuilds = 0
+        self.removeChecks = 0
+
+    def __gt__(self, other):
+        return self.metric > other.metric
+
+    def addRegion(self, region):
+        # append the region into this district
+        self.regions[region.id] = region
+        self.articulationPoints = None
+        # add the region's metric to the district's metric
+        if self.index != 0:
+            self.metric += region.values[self.metricIndex]
+            self.remainingOverhead -= region.values[self.metricIndex]
+        # remove this region from the adjacency list
+        self.adj.pop(region.id, None)
+        # for each adjacent region, add it to the adjacency list
+        for adjId in region.adjIds:
+            if adjId not in self.regions:
+                self.adj[adjId] = self.adj.get(adjId, 0) + 1
+
+        if self.index != 0:     Logger.s("+", self.index, region.name, self.regions.values())
+
+    def removeRegion(self, region):
+        if region.id not in self.regions:
+            return
+        # remove the region from this district
+        del self.regions[region.id]
+        self.articulationPoints = None
+        # subtract the region's metric to the district's metric
+        if self.index != 0:
+            self.metric -= region.values[self.metricIndex]
+            self.remainingOverhead += region.values[self.metricIndex]
+        # re-add this region to the adjacency list, and remove one from each adjacent region to this region
+        count = 0
+        for adjId in region.adjIds:
+            if adjId in self.regions:
+                count += 1
+            elif adjId in self.adj:
+                self.adj[adjId] -= 1
+                if self.adj[adjId] == 0:
+                    del self.adj[adjId]
+        if count > 0:
+            self.adj[region.id] = count
+
+        if self.index != 0:     Logger.s("-", self.index, region.name, self.regions.values())
+
+    def isAdjacent(self, region):
+        return len(self.adj) == 0 or region.id in self.adj
+
+    def canAdd(self, region):
+        return self.index == 0 or self.remainingOverhead >= region.values[self.metricIndex]
+
+    def canRemove(self, region):
+        # True if taking the region out wouldn't split the district up
+        self.removeChecks += 1
+        if self.articulationPoints is None:
+            self.articulationPoints = self.__getArticulationPoints()
+        return region.id not in self.articulationPoints
+
+    def __getArticulationPoints(self):
+        # Hopcroft-Tarjan over the regions in the district - a region is an articulation point if some part of the
+        # search tree below it can't get back above it without going through it
+        self.articulationBuilds += 1
+        points = set()
+        order = {}
+        low = {}
+        for root in self.regions:
+            if root in order:
+                continue
+            order[root] = low[root] = len(order)
+            rootChildren = 0
+            # Iterative, since counties can go much deeper than the recursion limit
+            stack = [(root, None, iter(self.regions[root].adjIds))]
+            while stack:
+                regionId, parent, neighbors = stack[-1]
+                for adjId in neighbors:
+                    if adjId == parent or adjId not in self.regions:
+                        continue
+                    if adjId in order:
+                        low[regionId] = min(low[regionId], order[adjId])
+                    else:
+                        order[adjId] = low[adjId] = len(order)
+                        stack.append((adjId, regionId, iter(self.regions[adjId].adjIds)))
+                        break
+                else:
+                    stack.pop()
+                    if parent == root:
+                        rootChildren += 1
+                    elif parent is not None:
+                        low[parent] = min(low[parent], low[regionId])
+                        if low[regionId] >= order[parent]:
+                            points.add(parent)
+            # The root only holds things together if the search had to leave it more than once
+            if rootChildren > 1:
+                points.add(root)
+        return points
+
+class DistrictHeap:
+    # The districts, smallest metric first - ties go to the lowest index, the same one min() would pick
+    # positions maps each district's index -> where it is in the heap, so a district can be moved when its metric changes
+    def __init__(self, districts):
+        self.heap = sorted(districts, key=lambda district: (district.metric, district.index))
+        self.positions = { district.index: i for i, district in enumerate(self.heap) }
+
+    def __len__(self):
+        return len(self.heap)
+
+    def min(self):
+        return self.heap[0]
+
+    def update(self, district):
+        # Move the district up or down to wherever its new metric puts it
+        i = self.positions[district.index]
+        if i > 0 and self.__isBefore(i, (i-1) // 2):
+            self.__siftUp(i)
+        else:
+            self.__siftDown(i)
+
+    def __isBefore(self, i, j):
+        a, b = self.heap[i], self.heap[j]
+        return (a.metric, a.index) < (b.metric, b.index)
+
+    def __swap(self, i, j):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.positions[self.heap[i].index] = i
+        self.positions[self.heap[j].index] = j
+
+    def __siftUp(self, i):
+        while i > 0 and self.__isBefore(i, parent := (i-1) // 2):
+            self.__swap(i, parent)
+            i = parent
+
+    def __siftDown(self, i):
+        while True:
+            smallest = i
+            for child in (2*i + 1, 2*i + 2):
+                if child < len(self.heap) and self.__isBefore(child, smallest):
+                    smallest = child
+            if smallest == i:
+                return
+            self.__swap(i, smallest)
+            i = smallest
+
+from collections import deque
+
+class ComponentTracker:
+    # The connected groups of unplaced regions, each kept as a District(0) so its adj is the placed regions around it
+    # componentOf maps region id -> the group it's in, and components is kept in the order the groups were made
+    def __init__(self, regions):
+        self.components = {}
+        self.componentOf = {}
+        regions = { region.id: region for region in regions }
+        while len(regions) > 0:
+            component = self.__newComponent()
+            queue = deque([regions.pop(next(iter(regions)))])
+            while len(queue) > 0:
+                region = queue.popleft()
+                self.__addTo(component, region)
+                for adjId in region.adjIds:
+                    if adjId in regions:
+                        queue.append(regions.pop(adjId))
+
+    def __iter__(self):
+        return iter(list(self.components))
+
+    def __len__(self):
+        return len(self.components)
+
+    def getComponent(self, regionId):
+        return self.componentOf.get(regionId)
+
+    def remove(self, region):
+        # Take out a region that's just been placed, splitting its group if that was holding it together
+        component = self.componentOf.pop(region.id, None)
+        if component is None:
+            return
+        component.removeRegion(region)
+        if len(component.regions) == 0:
+            del self.components[component]
+            return
+
+        starts = [ adjId for adjId in region.adjIds if adjId in component.regions ]
+        if len(starts) > 1:
+            for piece in self.__getSplitPieces(component, starts):
+                newComponent = self.__newComponent()
+                for regionId in piece:
+                    movedRegion = component.regions[regionId]
+                    component.removeRegion(movedRegion)
+                    self.__addTo(newComponent, movedRegion)
+
+    def add(self, region):
+        # Put back a region that's just been unplaced, joining up every group it touches
+        adjComponents = list({ self.componentOf[adjId]: None for adjId in region.adjIds if adjId in self.componentOf })
+        if len(adjComponents) == 0:
+            self.__addTo(self.__newComponent(), region)
+            return
+
+        # Keep the biggest, and move everything else into it
+        adjComponents.sort(key=lambda component: len(component.regions))
+        component = adjComponents.pop()
+        self.__addTo(component, region)
+        for other in adjComponents:
+            for otherRegion in other.regions.values():
+                self.__addTo(component, otherRegion)
+            del self.components[other]
+
+    def __newComponent(self):
+        component = District(0)
+        self.components[component] = None
+        return component
+
+    def __addTo(self, component, region):
+        component.addRegion(region)
+        self.componentOf[region.id] = component
+
+    def __getSplitPieces(self, component, starts):
+        # Search from each of the removed region's neighbors in lockstep, joining searches when they meet. Whenever a
+        # search runs out, it has found a whole piece that's been cut off - the last one left is what stays behind, so
+        # we only ever walk the smaller sides
+        groups = list(range(len(starts)))
+        owner = {}
+        queues = {}
+        members = {}
+        for i, start in enumerate(starts):
+            if start in owner:
+                groups[i] = owner[start]
+                continue
+            owner[start] = i
+            queues[i] = deque([start])
+            members[i] = [start]
+
+        def find(group):
+            while groups[group] != group:
+                groups[group] = groups[groups[group]]
+                group = groups[group]
+            return group
+
+        pieces = []
+        while len(queues) > 1:
+            for group in list(queues):
+                if group not in queues:
+                    continue
+                if len(queues[group]) == 0:
+                    pieces.append(members.pop(group))
+                    del queues[group]
+                    if len(queues) == 1:
+                        break
+                    continue
+
+                for adjId in component.regions[queues[group].popleft()].adjIds:
+                    if adjId not in component.regions:
+                        continue
+                    current = find(group)
+                    if adjId not in owner:
+                        owner[adjId] = current
+                        queues[current].append(adjId)
+                        members[current].append(adjId)
+                    elif (other := find(owner[adjId])) != current:
+                        # The two searches met - fold the smaller one into the bigger
+                        big, small = (current, other) if len(members[current]) >= len(members[other]) else (other, current)
+                        groups[small] = big
+                        queues[big].extend(queues.pop(small))
+                        members[big].extend(members.pop(small))
+                if len(queues) == 1:
+                    break
+        return pieces
+
+class CodeDistrict:
+    # The original district, keyed by region code - hunger_old and the other older engines still use this one
     def __init__(self, index, metricID=None, maxAcceptable=float("inf")):
         self.regions = set()
         self.adj = {}
@@ -114,15 +399,136 @@ class District:
                 return True
         return False
 
+# Failure stores - these remember the fingerprints of placements the solver has given up on
+
+from collections import OrderedDict
+from math import ceil, log
+import sys
+
+class FailureSet:
+    # Exact fingerprints, holding at most cap of them. When it's full the oldest go first - by the last time they were
+    # looked up for "lru", or when they were added for "age". Anything evicted can be retried, so too small a cap can
+    # leave the solver going around in circles
+    def __init__(self, cap=1000000, evict="lru"):
+        self.entries = OrderedDict()
+        self.cap = cap
+        self.evict = evict
+        self.evicted = 0
+        self.lookups = 0
+        self.hits = 0
+
+    def add(self, fingerprint, placement=None):
+        self.entries[fingerprint] = placement
+        self.entries.move_to_end(fingerprint)
+        while len(self.entries) > self.cap:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+    def __contains__(self, fingerprint):
+        self.lookups += 1
+        if fingerprint not in self.entries:
+            return False
+        self.hits += 1
+        if self.evict == "lru":
+            self.entries.move_to_end(fingerprint)
+        return True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def getPlacement(self, fingerprint):
+        # The placement the fingerprint was added with, if we were given one
+        return self.entries.get(fingerprint)
+
+    def getBytesUsed(self):
+        # The table itself, plus a 64-bit int for each key (placements kept for collision checks are extra)
+        return sys.getsizeof(self.entries) + len(self.entries) * sys.getsizeof(2**63)
+
+    def getHitRate(self):
+        return 0 if self.lookups == 0 else self.hits/self.lookups
+
+    def toArrays(self):
+        # For snapshots - just the fingerprints, oldest first, and not the placements kept for collision checks
+        return { "fingerprints": np.fromiter(self.entries, dtype=np.uint64, count=len(self.entries)) }
+
+    def fromArrays(self, arrays):
+        for fingerprint in arrays.get("fingerprints", np.empty(0, dtype=np.uint64)).tolist():
+            self.add(fingerprint)
+
+class BloomFailures:
+    # A fixed-size Bloom filter. It never forgets and never grows, but will occasionally (about errorRate of the time,
+    # once it's seen capacity failures) claim a placement failed when it didn't
+    def __init__(self, capacity=1000000, errorRate=0.001):
+        self.numBits = ceil(-capacity * log(errorRate) / log(2)**2)
+        self.numHashes = max(1, round(self.numBits / capacity * log(2)))
+        self.bits = bytearray((self.numBits + 7) // 8)
+        self.count = 0
+        self.lookups = 0
+        self.hits = 0
+
+    def __getIndices(self, fingerprint):
+        # Double hashing, off the two halves of the fingerprint
+        first = fingerprint & 0xFFFFFFFF
+        second = (fingerprint >> 32) | 1
+        return ((first + i*second) % self.numBits for i in range(self.numHashes))
+
+    def add(self, fingerprint, placement=None):
+        for index in self.__getIndices(fingerprint):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, fingerprint):
+        self.lookups += 1
+        if all(self.bits[index >> 3] & (1 << (index & 7)) for index in self.__getIndices(fingerprint)):
+            self.hits += 1
+            return True
+        return False
+
+    def __len__(self):
+        return self.count
+
+    def getPlacement(self, fingerprint):
+        return None
+
+    def getBytesUsed(self):
+        return sys.getsizeof(self.bits)
+
+    def getHitRate(self):
+        return 0 if self.lookups == 0 else self.hits/self.lookups
+
+    def toArrays(self):
+        return { "bloomBits": np.frombuffer(self.bits, dtype=np.uint8), "bloomCount": np.array(self.count) }
+
+    def fromArrays(self, arrays):
+        # Bits only mean anything to a filter of the same size - but exact fingerprints can go into any of them
+        if "bloomBits" in arrays and len(arrays["bloomBits"]) == len(self.bits):
+            self.bits = bytearray(arrays["bloomBits"].tobytes())
+            self.count = int(arrays["bloomCount"])
+        for fingerprint in arrays.get("fingerprints", np.empty(0, dtype=np.uint64)).tolist():
+            self.add(fingerprint)
+
 class Region:
-    def __init__(self, code, metrics, adj):
+    # Slotted, since counties have thousands of these. values holds the metrics in the order of metricNames (the
+    # dataset's allowed metrics, shared by every region)
+    __slots__ = ("code", "id", "scale", "values", "metricNames", "adj", "adjIds", "name", "hash", "distances")
+
+    def __init__(self, code, values, adj, name=None, regionId=None, scale=None, metricNames=()):
         self.code = code
-        self.metrics = metrics
+        self.id = regionId
+        self.scale = scale
+        self.values = tuple(values)
+        self.metricNames = metricNames
         self.adj = set(adj)
-        self.name = converter.abbrev_to_name[code]
+        self.adjIds = ()
+        self.name = name if name is not None else getConverter(scale).abbrev_to_name[code]
         self.hash = hash(code)
         self.distances = { }
 
+    @property
+    def metrics(self):
+        # Metric name -> value, for the older engines - the solver reads values by position instead
+        return dict(zip(self.metricNames, self.values))
+
     def __str__(self):
         return self.code
 
@@ -135,73 +541,110 @@ class Region:
     def __hash__(self):
         return self.hash
 
+    def __reduce__(self):
+        # Regions belong to their dataset, so unpickle to the receiving process' copy rather than sending ours
+        return (getRegion, (self.scale, self.code))
+
 # Helper file reading function
 import csv
+import importlib
+import numpy as np
+import hungerCache
+import hungerDistances
 
 scales = ["states", "counties"]
 scale = scales[0]
 
-if (scale == "states"):
-    #           0            1          2            3            4           5
-    metrics = ["Population","Firearms","Area (mi2)","Land (mi2)","GDP ($1m)","Food ($1k)"]
-    bannedIndices = []
-    allowed = [metric for index, metric in enumerate(metrics) if index not in bannedIndices]
-    broken = [metric for metric in metrics if metric not in allowed]
-    import assets.states.name_to_abbrev as converter
-elif (scale == "counties"):
-    #           0
-    metrics = ["Population"]
-    bannedIndices = []
-    allowed = [metric for index, metric in enumerate(metrics) if index not in bannedIndices]
-    broken = [metric for metric in metrics if metric not in allowed]
-    import assets.counties.name_to_abbrev as converter
-
-def getDistanceStep(distCode, regions):
-    dist = 0
-    distances = {region: (0 if region == distCode else -1) for region in regions}
-    changed = True
-    while changed:
-        changed = False
-        for region in (region for region in regions.values() if region.code in distances and distances[region.code] == dist):
-            for code in (code for code in region.adj if code in distances and distances[code] == -1):
-                changed = True
-                distances[code] = dist + 1
-        dist += 1
-        print("Calculating distances: {:10.4f}%".format(100*list(regions.keys()).index(distCode)/len(regions)), end="\r")
-
-    return { code: dist for code, dist in distances.items() if dist > 0 }
-
-def populateDistances(regions):
-    # Attempt to read in distance
+# The metrics available at each scale
+scaleMetrics = {
+    #            0            1          2            3            4           5
+    "states":   ["Population","Firearms","Area (mi2)","Land (mi2)","GDP ($1m)","Food ($1k)"],
+    #            0
+    "counties": ["Population"],
+}
+
+# The metrics which don't work at each scale, by index
+scaleBannedIndices = {
+    "states":   [],
+    "counties": [],
+}
+
+# Where distances come from:
+#   "matrix" - the full precomputed matrix, building it if needed
+#   "lazy"   - search from each region as it's needed, keeping the last lazyCacheSize rows (None for all of them -
+#              the solver ends up rereading every row, so anything less mostly misses)
+#   "auto"   - the matrix if it's already on disk, otherwise lazy
+distanceBackend = "auto"
+lazyCacheSize = None
+# Past this many regions, lazy distances are a lot slower than the matrix, so "auto" says when it's using them
+lazyWarnSize = 1000
+lazyWarned = set()
+
+def getConverter(forScale=None):
+    # The name lookup is a huge dict literal, so only import it when we actually need it
+    return importlib.import_module("assets." + (forScale or scale) + ".name_to_abbrev")
+
+def readDistances(forScale, codes, indptr, indices):
+    if distanceBackend == "lazy":
+        return hungerDistances.LazyDistances(indptr, indices, codes, lazyCacheSize)
+
+    # The compact binary matrix, if it's been built
+    distances = hungerDistances.load(forScale, codes)
+    if distances is not None and distances.shape == (len(codes), len(codes)):
+        return hungerDistances.DistanceMatrix(distances, codes)
+
+    # Convert the old csv format, or work it out ourselves if there's nothing on disk
+    distances = readDistanceCsv(forScale, codes)
+    if distances is None:
+        # Don't hold up startup building the whole thing unless we've been asked to
+        if distanceBackend == "auto":
+            if len(codes) > lazyWarnSize and forScale not in lazyWarned:
+                lazyWarned.add(forScale)
+                print("No distance matrix for {} - working distances out as they're needed, which is much slower. "
+                      "Build it with: python hungerDistances.py {}".format(forScale, forScale))
+            return hungerDistances.LazyDistances(indptr, indices, codes, lazyCacheSize)
+        distances = hungerDistances.build(forScale, indptr, indices, codes, doStatus=True)
+    else:
+        try:
+            hungerDistances.save(forScale, distances, codes)
+        except OSError:
+            pass
+
+    # Map the saved copy, so it's shared with everyone else
+    if (mapped := hungerDistances.load(forScale, codes)) is not None:
+        distances = mapped
+    return hungerDistances.DistanceMatrix(distances, codes)
+
+def readDistanceCsv(forScale, codes):
     try:
-        with open("assets/" + scale + "/distance.csv", encoding='utf8', newline='') as csvfile:
+        index = { code: i for i, code in enumerate(codes) }
+        distances = np.zeros((len(codes), len(codes)), dtype=np.uint8)
+        with open("assets/" + forScale + "/distance.csv", encoding='utf8', newline='') as csvfile:
             reader = csv.DictReader(csvfile, delimiter=',')
             for row in reader:
                 name = row.pop("name")
-                regions[name].distances = { code: int(dist) for code, dist in row.items() if dist }
-    except:
-        for code, region in regions.items():
-            region.distances = getDistanceStep(code, regions)
-        print()
-        with open("assets/" + scale + "/distance.csv", "w", encoding='utf8', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, delimiter=',', fieldnames=["name"] + list(regions.keys()))
-            writer.writeheader()
-            for region in regions.values():
-                newRow = region.distances.copy()
-                newRow["name"] = region.code
-                writer.writerow(newRow)
-
-def readFile():
+                for code, dist in row.items():
+                    if dist:
+                        distances[index[name], index[code]] = int(dist)
+        return distances
+    except (OSError, KeyError, ValueError):
+        return None
+
+def readSources(forScale=None):
+    forScale = forScale or scale
+    converter = getConverter(forScale)
+
     # Read in adjacency
     adj = {}
-    with open("assets/" + scale + "/adjacency.csv", encoding='utf8', newline='') as csvfile:
+    with open("assets/" + forScale + "/adjacency.csv", encoding='utf8', newline='') as csvfile:
         reader = csv.reader(csvfile, delimiter=',')
         for row in reader:
             adj[row[0]] = row[1:]
 
-    # Read in regions
-    regions = {}
-    with open("assets/" + scale + "/data.tsv", encoding='utf8', newline='') as csvfile:
+    # Read in regions - every metric for the scale goes in, so the compiled cache doesn't depend on what's banned
+    codes = []
+    values = []
+    with open("assets/" + forScale + "/data.tsv", encoding='utf8', newline='') as csvfile:
         reader = csv.DictReader(csvfile, delimiter='\t')
         for row in reader:
             code = row["Region"]
@@ -209,17 +652,98 @@ def readFile():
             if code == "Total":
                 continue
             # add the region and metrics
-            metrics = {key: int(value.strip().replace(',','')) for (key, value) in row.items() if key in allowed}
-            regions[code] = Region(code, metrics, adj[code])
-
-    populateDistances(regions)
-
-    return regions
-    
-regionlist = readFile()
+            codes.append(code)
+            values.append([ int(row[metric].strip().replace(',','')) for metric in scaleMetrics[forScale] ])
+
+    # Flatten the adjacency, keeping it in file order
+    # The adjacency file covers some places we don't have data for (territories, etc) - forget about those
+    index = { code: i for i, code in enumerate(codes) }
+    adjLists = [ [ index[adjCode] for adjCode in adj[code] if adjCode in index ] for code in codes ]
+    indptr = np.cumsum([0] + [ len(adjList) for adjList in adjLists ], dtype=np.int32)
+    indices = np.array([ i for adjList in adjLists for i in adjList ], dtype=np.int32)
+
+    return {
+        "codes":     np.array(codes),
+        "names":     np.array([ converter.abbrev_to_name[code] for code in codes ]),
+        "metrics":   np.array(scaleMetrics[forScale]),
+        "values":    np.array(values, dtype=np.int64),
+        "indptr":    indptr,
+        "indices":   indices,
+    }
+
+def readArrays(forScale):
+    # Use the compiled dataset if it's up to date
+    arrays = hungerCache.load(forScale)
+    if arrays is not None:
+        return arrays
+
+    # Otherwise go the slow way, and compile it for next time
+    arrays = readSources(forScale)
+    try:
+        hungerCache.save(forScale, arrays)
+    except OSError:
+        # Read-only installs just don't get the speedup
+        pass
+
+    return arrays
+
+class Dataset:
+    # Everything about one scale: its regions, metrics, adjacency and distances
+    def __init__(self, scale, arrays, distances=None):
+        self.scale = scale
+        # What it was built from, for sharing with other processes
+        self.arrays = arrays
+        self.metrics = arrays["metrics"].tolist()
+        self.allowed = [metric for index, metric in enumerate(self.metrics) if index not in scaleBannedIndices.get(scale, [])]
+        self.broken = [metric for metric in self.metrics if metric not in self.allowed]
+        self.codes = arrays["codes"].tolist()
+        self.indptr = arrays["indptr"]
+        self.indices = arrays["indices"]
+        self.distances = distances if distances is not None else readDistances(scale, self.codes, self.indptr, self.indices)
+
+        # Build the regions
+        self.names = arrays["names"].tolist()
+        indptr = self.indptr.tolist()
+        indices = self.indices.tolist()
+        columns = [ index for index, metric in enumerate(self.metrics) if metric in self.allowed ]
+        # Each allowed metric as a column indexed by region id, for the vectorized bits of the solver
+        self.columns = { metric: arrays["values"][:, column] for metric, column in zip(self.allowed, columns) }
+        values = arrays["values"][:, columns].tolist()
+
+        # regions is indexed by id, regionlist by code
+        self.regions = []
+        self.regionlist = {}
+        for i, code in enumerate(self.codes):
+            adjIds = tuple(indices[indptr[i]:indptr[i+1]])
+            region = Region(code, values[i], (self.codes[j] for j in adjIds), self.names[i], i, scale, self.allowed)
+            region.adjIds = adjIds
+            region.distances = self.distances.getRegionDistances(i)
+            self.regions.append(region)
+            self.regionlist[code] = region
+
+# Each scale is loaded the first time something asks for it, then kept for the life of the process
+datasets = {}
+
+def getDataset(forScale=None):
+    forScale = forScale or scale
+    if forScale not in datasets:
+        datasets[forScale] = Dataset(forScale, readArrays(forScale))
+    return datasets[forScale]
+
+def getRegion(forScale, code):
+    return getDataset(forScale).regionlist[code]
+
+def __getattr__(name):
+    # The module-level names from before there were datasets, which all refer to the default scale
+    if name in ["regionlist", "metrics", "allowed", "broken"]:
+        return getattr(getDataset(), name)
+    elif name == "distanceSource":
+        return getDataset().distances
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 def debugCheckForMissingEntries(adj, regions):
     adj_set = set(adj.keys())
+    converter = getConverter()
     name_set = set(converter.abbrev_to_name.keys())
     data_set = set(regions.keys())
 
@@ -283,23 +807,44 @@ def printDistances(distances):
             distList.append(k)
             distList.append(v)
         print("{} --> ".format(distCode) + "|".join(["{}{:2}:{:2}" + Style.RESET_ALL]*len(distances)).format(*distList))
-    # Attempt to read in distance
-    try:
-        with open("assets/" + scale + "/distance.csv", encoding='utf8', newline='') as csvfile:
-            distanceMatrix = {}
-            reader = csv.DictReader(csvfile, delimiter=',')
-            for row in reader:
-                name = row.pop("name")
-                distanceMatrix[name] = { code: int(dist) for code, dist in row.items() if dist }
-    except:
-        distanceMatrix = { region: getDistanceStep(region) for region in regionlist }
-        print()
-        with open("assets/" + scale + "/distance.csv", "w", encoding='utf8', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, delimiter=',', fieldnames=["name"] + list(distanceMatrix.keys()))
-            writer.writeheader()
-            for code, distances in distanceMatrix.items():
-                newRow = distances.copy()
-                newRow["name"] = code
-                writer.writerow(newRow)
-
-    return distanceMatrix
\ No newline at end of file
+
+def getSizeOf(obj, seen):
+    # Bytes used by obj and whatever containers it holds, counting anything in seen (by id) as free
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(getSizeOf(key, seen) + getSizeOf(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (tuple, list, set, frozenset)):
+        size += sum(getSizeOf(item, seen) for item in obj)
+    return size
+
+def getObjectSize(obj, exclude=()):
+    # Bytes used by an object's own attributes - anything in exclude (like the regions a district holds) isn't counted
+    seen = { id(item) for item in exclude }
+    size = getSizeOf(obj, seen)
+    for slot in getattr(type(obj), "__slots__", ()):
+        if hasattr(obj, slot):
+            size += getSizeOf(getattr(obj, slot), seen)
+    if hasattr(obj, "__dict__"):
+        size += getSizeOf(obj.__dict__, seen)
+    return size
+
+def printMemoryReport(forScales=None):
+    # How much the regions, and a district holding all of them, take up at each scale
+    for forScale in forScales or scales:
+        dataset = getDataset(forScale)
+        regionBytes = sum(getObjectSize(region) for region in dataset.regions)
+        district = District(1, 0)
+        for region in dataset.regions:
+            district.addRegion(region)
+        districtBytes = getObjectSize(district, dataset.regions)
+
+        print("{:>10}: {:5} regions, {:7.1f} bytes/region ({:7.1f}KB), {:7.1f} bytes/region in a district ({:7.1f}KB)".format(
+              forScale,
+              len(dataset.regions),
+              regionBytes/len(dataset.regions),
+              regionBytes/1024,
+              districtBytes/len(dataset.regions),
+              districtBytes/1024))
\ No newline at end of file
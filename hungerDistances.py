@@ -0,0 +1,286 @@
+# Hop distances between regions
+#
+# The distance matrix is built with a breadth-first search from every region at once: each level expands the whole
+# frontier (every source's newly-reached regions) through the CSR adjacency in a handful of numpy operations. Sources
+# are split into chunks which are farmed out to a process pool, and each finished chunk is saved to disk so an
+# interrupted build picks up where it left off.
+#
+# Row and column i are whichever region was i-th in data.tsv when it was built, so the region codes in that order are
+# saved alongside (distance.codes.npy, and codes.npy with the checkpoints) and the matrix is only used for the same ones.
+#
+# The finished matrix is a dense uint8 (region x region) .npy, indexed by region id. It's memory-mapped rather than
+# read in, so every process using a scale shares one copy through the page cache (~10MB for counties). Where even that
+# is too much (or it hasn't been built yet), LazyDistances does the search for one row at a time as it's needed.
+
+import numpy as np
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from multiprocessing import Pool
+
+chunkSize = 128
+
+def getMatrixPath(scale):
+    return "assets/" + scale + "/distance.npy"
+
+def getCheckpointPath(scale):
+    return "assets/" + scale + "/distance.partial"
+
+def getCodesPath(scale):
+    return "assets/" + scale + "/distance.codes.npy"
+
+def saveArray(path, array):
+    # Through a temp file of its own, so processes saving at the same time can't swap in each other's half-written ones
+    handle, tempPath = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(handle, "wb") as tempFile:
+            np.save(tempFile, array)
+        os.replace(tempPath, path)
+    except BaseException:
+        os.unlink(tempPath)
+        raise
+
+def matchesCodes(path, codes):
+    # Whether the codes saved at path are these ones, in this order
+    if codes is None:
+        return False
+    try:
+        return np.load(path, allow_pickle=False).tolist() == list(codes)
+    except (OSError, ValueError):
+        return False
+
+def getDistanceRows(indptr, indices, sources):
+    # Returns a (sources x regions) matrix of hop counts - 0 for the source itself, and for anything unreachable
+    numRegions = len(indptr) - 1
+    degrees = np.diff(indptr)
+    distances = np.zeros((len(sources), numRegions), dtype=np.uint16)
+    visited = np.zeros((len(sources), numRegions), dtype=bool)
+
+    # The frontier is a list of (row, region) pairs - row being which source reached it
+    rows = np.arange(len(sources))
+    cols = np.asarray(sources, dtype=np.int64)
+    visited[rows, cols] = True
+
+    dist = 0
+    while len(cols) > 0:
+        dist += 1
+        # Expand every frontier region into its neighbors
+        counts = degrees[cols]
+        offsets = np.cumsum(counts) - counts
+        rows = np.repeat(rows, counts)
+        cols = indices[np.repeat(indptr[cols] - offsets, counts) + np.arange(counts.sum())]
+
+        # Keep the ones we haven't seen yet, once each
+        unseen = ~visited[rows, cols]
+        reached = np.unique(rows[unseen] * numRegions + cols[unseen])
+        rows, cols = reached // numRegions, reached % numRegions
+
+        visited[rows, cols] = True
+        distances[rows, cols] = dist
+
+    return distances
+
+# Each worker gets the adjacency once, rather than once per chunk
+workerGraph = None
+
+def initWorker(indptr, indices):
+    global workerGraph
+    workerGraph = (indptr, indices)
+
+def buildChunk(task):
+    start, end, checkpointPath = task
+    rows = getDistanceRows(*workerGraph, np.arange(start, end))
+    if checkpointPath:
+        tempPath = "{}/{}-{}.tmp.npy".format(checkpointPath, start, end)
+        np.save(tempPath, rows)
+        os.replace(tempPath, "{}/{}-{}.npy".format(checkpointPath, start, end))
+    return start, end, rows
+
+def buildDistanceMatrix(indptr, indices, workers=None, checkpointPath=None, doStatus=False, codes=None):
+    indptr = np.asarray(indptr, dtype=np.int64)
+    indices = np.asarray(indices, dtype=np.int64)
+    numRegions = len(indptr) - 1
+    distances = np.zeros((numRegions, numRegions), dtype=np.uint16)
+
+    # Chunks from a previous run are only any use if they were for the same regions in the same order
+    if checkpointPath:
+        codesPath = os.path.join(checkpointPath, "codes.npy")
+        if not matchesCodes(codesPath, codes):
+            shutil.rmtree(checkpointPath, ignore_errors=True)
+            os.makedirs(checkpointPath, exist_ok=True)
+            if codes is not None:
+                saveArray(codesPath, np.array(codes))
+
+    # Pick up any chunks a previous run finished
+    tasks = []
+    for start in range(0, numRegions, chunkSize):
+        end = min(start + chunkSize, numRegions)
+        chunkPath = "{}/{}-{}.npy".format(checkpointPath, start, end)
+        if checkpointPath and os.path.exists(chunkPath):
+            distances[start:end] = np.load(chunkPath)
+        else:
+            tasks.append((start, end, checkpointPath))
+
+    done = numRegions - sum(end - start for start, end, _ in tasks)
+    with Pool(workers, initializer=initWorker, initargs=(indptr, indices)) as pool:
+        for start, end, rows in pool.imap_unordered(buildChunk, tasks):
+            distances[start:end] = rows
+            done += end - start
+            if doStatus:    print("Calculating distances: {:10.4f}%".format(100*done/numRegions), end="\r")
+
+    if doStatus:    print()
+
+    # Almost every map fits in a byte
+    return distances.astype(np.uint8) if distances.max(initial=0) <= np.iinfo(np.uint8).max else distances
+
+def build(scale, indptr, indices, codes, workers=None, doStatus=False):
+    # Build and save the matrix for a scale, resuming from (and then cleaning up) any checkpoints
+    checkpointPath = getCheckpointPath(scale)
+    distances = buildDistanceMatrix(indptr, indices, workers, checkpointPath, doStatus, codes)
+
+    save(scale, distances, codes)
+    shutil.rmtree(checkpointPath, ignore_errors=True)
+
+    return distances
+
+def save(scale, distances, codes):
+    # The codes go last - until they're there, the new matrix won't match anything and just gets rebuilt
+    saveArray(getMatrixPath(scale), distances)
+    saveArray(getCodesPath(scale), np.array(codes))
+
+def isFresh(scale):
+    # The matrix is stale if the files it was made from have changed since it was written
+    try:
+        builtTime = os.stat(getMatrixPath(scale)).st_mtime_ns
+    except OSError:
+        return False
+
+    for filename in ["adjacency.csv", "distance.csv"]:
+        try:
+            if os.stat("assets/" + scale + "/" + filename).st_mtime_ns > builtTime:
+                return False
+        except OSError:
+            pass
+    return True
+
+def load(scale, codes):
+    # None unless there's an up to date matrix for exactly these regions, in this order
+    if not isFresh(scale) or not matchesCodes(getCodesPath(scale), codes):
+        return None
+    try:
+        return np.load(getMatrixPath(scale), mmap_mode='r', allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+
+class DistanceMatrix:
+    def __init__(self, matrix, codes):
+        self.matrix = matrix
+        self.codes = codes
+        self.index = { code: i for i, code in enumerate(codes) }
+
+    def row(self, regionId):
+        return self.matrix[regionId]
+
+    def get(self, fromId, toId):
+        return int(self.matrix[fromId, toId])
+
+    def getRegionDistances(self, regionId):
+        return RegionDistances(self, regionId)
+
+class LazyDistances:
+    # Works out rows of the distance matrix as they're asked for, keeping up to capacity of the most recently used
+    # ones around. This saves building the matrix up front, not memory - the solver reads a row every time it places
+    # or unplaces a region, and rereads every placed region's row whenever its nearest placed distances go stale, so
+    # over a solve it wants every row, and any capacity short of the number of regions (the default) thrashes
+    def __init__(self, indptr, indices, codes, capacity=None):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.codes = codes
+        self.index = { code: i for i, code in enumerate(codes) }
+        self.capacity = capacity or len(codes)
+        self.rows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def row(self, regionId):
+        if (row := self.rows.get(regionId)) is not None:
+            self.hits += 1
+            self.rows.move_to_end(regionId)
+            return row
+
+        self.misses += 1
+        row = getDistanceRows(self.indptr, self.indices, [regionId])[0]
+        row = row.astype(np.uint8) if row.max(initial=0) <= np.iinfo(np.uint8).max else row
+        row.flags.writeable = False
+        self.rows[regionId] = row
+        if len(self.rows) > self.capacity:
+            self.rows.popitem(last=False)
+        return row
+
+    def get(self, fromId, toId):
+        # Distances are symmetric, so use whichever row we already have
+        if toId in self.rows and fromId not in self.rows:
+            fromId, toId = toId, fromId
+        return int(self.row(fromId)[toId])
+
+    def getRegionDistances(self, regionId):
+        return RegionDistances(self, regionId)
+
+    def getHitRate(self):
+        total = self.hits + self.misses
+        return 0 if total == 0 else self.hits/total
+
+class RegionDistances:
+    # Behaves like the old { code: hops } dict for a single region (0s being absent), but reads from the shared matrix
+    __slots__ = ("owner", "id")
+
+    def __init__(self, owner, regionId):
+        self.owner = owner
+        self.id = regionId
+
+    @property
+    def row(self):
+        return self.owner.row(self.id)
+
+    def get(self, code, default=None):
+        toId = self.owner.index.get(code)
+        dist = 0 if toId is None else self.owner.get(self.id, toId)
+        return dist if dist else default
+
+    def __getitem__(self, code):
+        if (dist := self.get(code)) is None:
+            raise KeyError(code)
+        return dist
+
+    def __contains__(self, code):
+        return self.get(code) is not None
+
+    def items(self):
+        row = self.row
+        reachable = np.flatnonzero(row)
+        return zip((self.owner.codes[toId] for toId in reachable.tolist()), row[reachable].tolist())
+
+    def keys(self):
+        return (code for code, _ in self.items())
+
+    def values(self):
+        return (dist for _, dist in self.items())
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        return int(np.count_nonzero(self.row))
+
+if __name__ == '__main__':
+    import sys
+    from datetime import datetime as dt
+    import hungerDataStructs as ds
+
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    for scale in sys.argv[1:2] or ["states"]:
+        arrays = ds.readSources(scale)
+        startTime = dt.now()
+        distances = build(scale, arrays["indptr"], arrays["indices"], arrays["codes"].tolist(), workers, doStatus=True)
+        print("Built {} {} distances to {} in {:.3f}s".format(scale, distances.shape, getMatrixPath(scale), (dt.now() - startTime).total_seconds()))
@@ -0,0 +1,149 @@
+# Multilevel solving
+#
+# County solves cost far more than state ones, but the county map is mostly the state map with more detail. This
+# coarsens the counties into a much smaller graph - by state (the first two digits of a county's FIPS code), or by
+# heavy edge matching - solves that with the usual Solver, projects the districts back down onto the counties, and then
+# only has to refine the counties along the borders between districts.
+#
+# Coarse graphs are datasets like any other, registered under a made-up scale ("counties/state"), so they only exist
+# in the process that made them - don't hand their solvers to other processes.
+
+import numpy as np
+import hunger as h
+import hungerDataStructs as ds
+import hungerDistances
+from time import perf_counter
+
+def getStateGroups(dataset):
+    # Group id by region id, and a code and name for each group - the state's abbreviation, from the county names
+    # ("Autauga County, AL"), falling back on the FIPS prefix
+    prefixes = sorted({ code[:2] for code in dataset.codes })
+    index = { prefix: i for i, prefix in enumerate(prefixes) }
+    groups = np.array([ index[code[:2]] for code in dataset.codes ], dtype=np.int64)
+
+    codes = list(prefixes)
+    for code, name in zip(dataset.codes, dataset.names):
+        if ", " in name:
+            codes[index[code[:2]]] = name.rsplit(", ", 1)[1]
+    return groups, codes, list(codes)
+
+def getMatchingGroups(dataset, metricID, maxWeight, targetSize):
+    # Heavy edge matching: each pass pairs every group with the unpaired neighbor it shares the most borders with
+    # (lightest first, and the lighter neighbor on ties), so long as the pair stays under maxWeight. Passes repeat
+    # until there are only targetSize groups, or nothing else will pair up
+    weights = dataset.columns[metricID].astype(np.float64)
+    rows = np.repeat(np.arange(len(dataset.codes)), np.diff(dataset.indptr))
+    groups = np.arange(len(dataset.codes))
+    numGroups = len(dataset.codes)
+
+    while numGroups > targetSize:
+        groupWeights = np.bincount(groups, weights, minlength=numGroups)
+        pairs, borders = np.unique(groups[rows] * numGroups + groups[dataset.indices], return_counts=True)
+        neighbors = {}
+        for pair, count in zip(pairs.tolist(), borders.tolist()):
+            if pair // numGroups != pair % numGroups:
+                neighbors.setdefault(pair // numGroups, []).append((count, pair % numGroups))
+
+        match = np.full(numGroups, -1)
+        for group in np.argsort(groupWeights, kind="stable").tolist():
+            if match[group] >= 0:
+                continue
+            options = [ (count, -groupWeights[neighbor], neighbor) for count, neighbor in neighbors.get(group, [])
+                        if match[neighbor] < 0 and groupWeights[group] + groupWeights[neighbor] <= maxWeight ]
+            if options:
+                neighbor = max(options)[2]
+                match[group] = neighbor
+                match[neighbor] = group
+
+        if not (match >= 0).any():
+            break
+
+        # Each pair (or leftover) becomes one group, numbered by its lowest member
+        leaders = np.where(match >= 0, np.minimum(np.arange(numGroups), match), np.arange(numGroups))
+        _, relabel = np.unique(leaders, return_inverse=True)
+        groups = relabel[groups]
+        numGroups = int(relabel.max()) + 1
+
+    # Named after the biggest region in each
+    biggest = {}
+    for regionId in np.argsort(weights, kind="stable").tolist():
+        biggest[int(groups[regionId])] = regionId
+    codes = [ "G{}".format(group) for group in range(numGroups) ]
+    names = [ "{} and around".format(dataset.names[biggest[group]]) for group in range(numGroups) ]
+    return groups, codes, names
+
+def coarsen(dataset, groups, codes, names, scale):
+    # Builds and registers the dataset for a grouping - metrics summed, groups adjacent if any of their regions are
+    numGroups = len(codes)
+    columns = np.column_stack([ dataset.columns[metric] for metric in dataset.allowed ])
+    values = np.zeros((numGroups, len(dataset.allowed)), dtype=columns.dtype)
+    np.add.at(values, groups, columns)
+
+    rows = np.repeat(np.arange(len(dataset.codes)), np.diff(dataset.indptr))
+    pairs = np.unique(groups[rows] * numGroups + groups[dataset.indices])
+    pairs = pairs[pairs // numGroups != pairs % numGroups]
+    indptr = np.concatenate([ [ 0 ], np.cumsum(np.bincount(pairs // numGroups, minlength=numGroups)) ])
+    indices = pairs % numGroups
+
+    arrays = { "metrics": np.array(dataset.allowed),
+               "codes":   np.array(codes),
+               "names":   np.array(names),
+               "values":  values,
+               "indptr":  indptr,
+               "indices": indices }
+    distances = hungerDistances.DistanceMatrix(hungerDistances.getDistanceRows(indptr, indices, range(numGroups)), codes)
+    ds.datasets[scale] = ds.Dataset(scale, arrays, distances)
+    return ds.datasets[scale]
+
+def fillUnplaced(dataset, placement, metricID):
+    # The coarse solve can run out of time with groups still unplaced - grow the smallest district that borders any of
+    # them by one region at a time until they're gone, so there's a whole plan to refine. Anything no district can
+    # reach is left for the solver
+    placement = placement.copy()
+    totals = np.bincount(placement, dataset.columns[metricID].astype(np.float64), minlength=placement.max() + 1)
+    rows = np.repeat(np.arange(len(dataset.codes)), np.diff(dataset.indptr))
+    while True:
+        edges = np.flatnonzero((placement[rows] == 0) & (placement[dataset.indices] > 0))
+        if len(edges) == 0:
+            return placement
+        edge = edges[np.argmin(totals[placement[dataset.indices[edges]]])]
+        district = placement[dataset.indices[edge]]
+        placement[rows[edge]] = district
+        totals[district] += dataset.columns[metricID][rows[edge]]
+
+def solve(metricID, numDist, scale="counties", coarsening="state", seed=None, coarseBudget=1, timeBudget=None, maxMoves=None):
+    # Solve coarse, project, refine - and if refining alone can't get it there, carry on with the usual search from
+    # the refined plan, for whatever's left of timeBudget
+    startTime = perf_counter()
+    dataset = h.getDataset(scale)
+    metric = metricID if isinstance(metricID, str) else dataset.allowed[metricID]
+
+    if coarsening == "state":
+        groups, codes, names = getStateGroups(dataset)
+    elif coarsening == "matching":
+        # Small enough groups that every district gets plenty of them to balance with
+        maxWeight = dataset.columns[metric].sum() / numDist / 8
+        groups, codes, names = getMatchingGroups(dataset, metric, maxWeight, max(64, 16*numDist))
+    else:
+        raise ValueError("Unknown coarsening {}".format(coarsening))
+    coarseScale = "{}/{}".format(scale, coarsening)
+    coarsen(dataset, groups, codes, names, coarseScale)
+
+    # The coarse solve doesn't need to get under the target itself - just somewhere close, for refining to finish off
+    coarse = h.Solver(metric, numDist, coarseScale, seed=seed).solve(timeBudget=coarseBudget)
+    placement = fillUnplaced(dataset, coarse.bestPlacement[groups], metric)
+    solver = h.Solver(metric, numDist, scale, seed=seed).setPlacement(placement).refine(maxMoves)
+
+    if not solver.isSolved():
+        solver.solve(timeBudget=None if timeBudget is None else max(0, timeBudget - (perf_counter() - startTime)))
+    return solver
+
+if __name__ == '__main__':
+    import sys
+
+    coarsening = sys.argv[1] if len(sys.argv) > 1 else "state"
+    for numDist in range(2, 11):
+        startTime = perf_counter()
+        solver = solve("Population", numDist, coarsening=coarsening, timeBudget=30)
+        print("\t{:>10}({}) took {:.3f}s ({:.3f}%){}".format("Population", numDist, perf_counter() - startTime,
+              solver.getStandardDevAsPercent(), "" if solver.isSolved() else " - out of time"))
@@ -0,0 +1,69 @@
+# Portfolio solving
+#
+# Solve times are heavy-tailed - most (metric, count) pairs take a fraction of a second, but a few get stuck
+# backtracking for much longer, and which ones depends on how ties happen to be broken. Rather than wait on one solve,
+# this races several differently-seeded solvers (and the old engine, where it can run) on a process pool, takes the
+# first one to finish, and terminates the rest.
+
+import hunger as h
+import hungerShared
+from multiprocessing import Pool, TimeoutError
+from time import perf_counter
+
+# How long past timeBudget to wait for stragglers - budgeted solvers only check it between steps
+deadlineGrace = 1
+
+def getStrategies(scale=None, count=4):
+    # (engine, seed) pairs - the plain solver, some seeded ones, and hunger_old, which only knows the default scale.
+    # The seeded ones only change tie-breaks and keep the biggest-first start (starterChoices): on states, seeds 1-5
+    # solve every metric at 2-6 districts, but starting at even the second biggest leaves Area and Firearms thrashing
+    strategies = [ ("hunger", None) ] + [ ("hunger", seed) for seed in range(1, count) ]
+    if (scale or h.scale) == h.scale:
+        strategies.append(("hunger_old", None))
+    return strategies
+
+def solveStrategy(task):
+    (engine, seed), metricID, numDist, scale, timeBudget = task
+    if engine == "hunger_old":
+        import hunger_old
+        solver = hunger_old.Solver(metricID, numDist).solve()
+    else:
+        solver = h.Solver(metricID, numDist, scale, seed=seed).solve(timeBudget=timeBudget)
+    return (engine, seed), solver if solver.isSolved() else None
+
+def solve(metricID, numDist, scale=None, strategies=None, workers=None, timeBudget=None):
+    # Returns the (engine, seed) which won and its solver, or (None, None) if none of them finished in timeBudget
+    # hunger_old has no budget of its own, so the deadline is kept here too
+    strategies = strategies or getStrategies(scale)
+    deadline = None if timeBudget is None else perf_counter() + timeBudget + deadlineGrace
+    tasks = [ (strategy, metricID, numDist, scale, timeBudget) for strategy in strategies ]
+
+    # Share the dataset with the workers, and take it down again if we were the ones to put it up
+    published = (scale or h.scale) not in hungerShared.blocks
+    handle = hungerShared.publish(scale)
+    try:
+        with Pool(workers or len(strategies), initializer=hungerShared.attachAll, initargs=([handle],)) as pool:
+            results = pool.imap_unordered(solveStrategy, tasks)
+            for _ in tasks:
+                try:
+                    strategy, solver = results.next(None if deadline is None else max(0, deadline - perf_counter()))
+                except TimeoutError:
+                    break
+                if solver is not None:
+                    # Leaving the with block terminates everyone still going
+                    return strategy, solver
+        return None, None
+    finally:
+        if published:
+            hungerShared.unpublish(scale)
+
+if __name__ == '__main__':
+    import sys
+    from time import perf_counter
+
+    scale = sys.argv[1] if len(sys.argv) > 1 else None
+    for metricID in range(len(h.getDataset(scale).allowed)):
+        for numDist in range(1, 7):
+            startTime = perf_counter()
+            strategy, solver = solve(metricID, numDist, scale)
+            print("\t{:>10}({}) took {:.3f}s with {}".format(h.getDataset(scale).allowed[metricID], numDist, perf_counter() - startTime, strategy))
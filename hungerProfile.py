@@ -0,0 +1,66 @@
+# Phase profiling for the solver
+#
+# The solver's steps are split into phases (getMinDistrict, getSeed, getUnplaced, selectFailed, unplace, place,
+# checkUnused). Set Solver.phaseProfiler to PhaseProfiler (or something that makes one) and each solver gets its own,
+# which times every phase with perf_counter_ns. Left as None, the solver skips all of it.
+#
+# Each phase gets a count, a total, and a histogram of how long it took, bucketed by powers of two nanoseconds. With
+# trace=True it also keeps every phase as an event, which saveTrace writes in the Chrome trace-event format - open it
+# in chrome://tracing or https://ui.perfetto.dev to see the solve laid out over time.
+
+import json
+from time import perf_counter_ns
+
+class PhaseProfiler:
+    def __init__(self, trace=False, maxEvents=1000000):
+        self.counts = {}
+        self.totals = {}
+        self.histograms = {}
+        self.trace = trace
+        self.maxEvents = maxEvents
+        self.events = []
+        self.firstTime = perf_counter_ns()
+        self.lastTime = self.firstTime
+
+    def start(self):
+        # Start timing a new phase
+        self.lastTime = perf_counter_ns()
+
+    def mark(self, tag):
+        # The current phase was tag - record it, and start timing the next one
+        now = perf_counter_ns()
+        elapsed = now - self.lastTime
+        self.counts[tag] = self.counts.get(tag, 0) + 1
+        self.totals[tag] = self.totals.get(tag, 0) + elapsed
+
+        # Bucket 0 is under 1ns, bucket n is [2**(n-1), 2**n)ns
+        histogram = self.histograms.setdefault(tag, {})
+        bucket = elapsed.bit_length()
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+        if self.trace and len(self.events) < self.maxEvents:
+            self.events.append((tag, self.lastTime, elapsed))
+        self.lastTime = now
+
+    def getSeconds(self, tag):
+        return self.totals.get(tag, 0) / 1e9
+
+    def toDict(self):
+        return { tag: { "count":     self.counts[tag],
+                        "totalNs":   self.totals[tag],
+                        "meanNs":    self.totals[tag] / self.counts[tag],
+                        # Keyed by the top of each bucket
+                        "histogram": { str(2**bucket): count for bucket, count in sorted(self.histograms[tag].items()) } }
+                 for tag in sorted(self.counts) }
+
+    def saveJson(self, path):
+        with open(path, "w") as jsonFile:
+            json.dump(self.toDict(), jsonFile, indent=2)
+
+    def saveTrace(self, path, name="solve"):
+        # Complete ("X") events, in microseconds since the profiler was made
+        events = [ { "name": tag, "cat": name, "ph": "X", "pid": 0, "tid": 0,
+                     "ts": (start - self.firstTime) / 1000, "dur": elapsed / 1000 }
+                   for tag, start, elapsed in self.events ]
+        with open(path, "w") as traceFile:
+            json.dump({ "traceEvents": events, "displayTimeUnit": "ns" }, traceFile)
@@ -0,0 +1,189 @@
+# Solver service
+#
+# Every Pool in tester.py, every GUI process and every CLI run pays for the imports and dataset loading before it does
+# any work. This keeps all of that warm in one long-lived process instead: it publishes the datasets (see
+# hungerShared.py), keeps a pool of workers attached to them, remembers the results of solves that will always come out
+# the same, and takes jobs over a multiprocessing.managers endpoint on localhost.
+#
+# Start it with "python hungerService.py [scales...]", then connect() from anywhere else. Jobs and results are the same
+# as hungerBatch's - small dicts both ways. solveBatch and solveJob here fall back to doing the work locally if there's
+# no service running, so callers don't have to care.
+#
+# The endpoint unpickles whatever it's sent (and so do its clients), so both ends prove they know a key first. The key
+# is made fresh each run, and handed to clients through a file only its user can read, or HUNGER_SOLVER_KEY (hex) if
+# that's set. Anything on the port that can't prove it - a squatter, or an old service - is treated as no service.
+
+import hunger as h
+import hungerBatch
+import hungerShared
+import os
+from collections import OrderedDict
+from multiprocessing import AuthenticationError, Pool, cpu_count
+from multiprocessing.managers import BaseManager, IteratorProxy
+from threading import Lock
+from time import perf_counter
+
+address = ("localhost", 50505)
+keyPath = os.path.join(os.path.expanduser("~"), ".hunger_solver", "service.key")
+keyVariable = "HUNGER_SOLVER_KEY"
+
+class SolverService:
+    # Results kept for repeat jobs - a counties summary is a few KB
+    cacheSize = 4096
+
+    def __init__(self, scales=None, workers=None):
+        self.scales = list(scales or [h.scale])
+        self.handles = [ hungerShared.publish(scale) for scale in self.scales ]
+        self.workers = workers or cpu_count()
+        self.pool = Pool(self.workers, initializer=hungerShared.attachAll, initargs=(self.handles,))
+        self.results = OrderedDict()
+        self.lock = Lock()
+        self.jobs = 0
+        self.hits = 0
+        self.startTime = perf_counter()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        for scale in self.scales:
+            hungerShared.unpublish(scale)
+
+    @staticmethod
+    def getKey(job):
+        # Only solves without a time budget always come out the same, so only those are worth remembering
+        if not isinstance(job, dict):
+            job = dict(metric=job[0], count=job[1])
+        if job.get("timeBudget") is not None:
+            return None
+        return (job["metric"], job["count"], job.get("scale") or h.scale, job.get("seed"), job.get("maxSteps"))
+
+    def __getCached(self, key):
+        with self.lock:
+            self.jobs += 1
+            if key is None or key not in self.results:
+                return None
+            self.hits += 1
+            self.results.move_to_end(key)
+            return self.results[key]
+
+    def __addCached(self, key, result):
+        if key is None:
+            return
+        with self.lock:
+            self.results[key] = result
+            if len(self.results) > self.cacheSize:
+                self.results.popitem(last=False)
+
+    def solve(self, job):
+        key = SolverService.getKey(job)
+        result = self.__getCached(key)
+        if result is None:
+            result = self.pool.apply(hungerBatch.solveJob, (job,))
+            self.__addCached(key, result)
+        return result
+
+    def solveBatch(self, jobs):
+        # Yields the summaries as they finish - the cached ones first. Clients get it as an iterator proxy, so they see
+        # each one as soon as it's done rather than all of them at the end
+        jobs = list(jobs)
+        keys = [ SolverService.getKey(job) for job in jobs ]
+        results = [ self.__getCached(key) for key in keys ]
+        todo = [ (key, job) for key, job, result in zip(keys, jobs, results) if result is None ]
+
+        yield from (result for result in results if result is not None)
+        for key, result in self.pool.imap_unordered(solveKeyedJob, todo):
+            self.__addCached(key, result)
+            yield result
+
+    def getStats(self):
+        with self.lock:
+            return { "scales":  self.scales,
+                     "workers": self.workers,
+                     "jobs":    self.jobs,
+                     "hits":    self.hits,
+                     "cached":  len(self.results),
+                     "uptime":  perf_counter() - self.startTime }
+
+def solveKeyedJob(task):
+    # Brings the cache key back with the result, since they finish in any order
+    key, job = task
+    return key, hungerBatch.solveJob(job)
+
+class ServiceManager(BaseManager):
+    pass
+
+# solveBatch's results come back through a proxy for the generator, which stays in the service
+resultTypes = { "solveBatch": "Iterator" }
+ServiceManager.register("getService", method_to_typeid=resultTypes)
+ServiceManager.register("Iterator", proxytype=IteratorProxy, create_method=False)
+
+def makeKey():
+    # From the environment if it's set, otherwise a new one, saved where only this user can read it
+    if keyVariable in os.environ:
+        return bytes.fromhex(os.environ[keyVariable])
+    key = os.urandom(32)
+    os.makedirs(os.path.dirname(keyPath), mode=0o700, exist_ok=True)
+    keyFile = os.open(keyPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(keyFile, "w") as keyFile:
+        os.chmod(keyPath, 0o600)
+        keyFile.write(key.hex())
+    return key
+
+def readKey():
+    # The running service's key, or None if there's no telling what it is
+    if keyVariable in os.environ:
+        return bytes.fromhex(os.environ[keyVariable])
+    try:
+        with open(keyPath) as keyFile:
+            return bytes.fromhex(keyFile.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def serve(scales=None, workers=None):
+    # Runs until interrupted
+    service = SolverService(scales, workers)
+    ServiceManager.register("getService", callable=lambda: service, method_to_typeid=resultTypes)
+    key = makeKey()
+    try:
+        ServiceManager(address=address, authkey=key).get_server().serve_forever()
+    finally:
+        service.close()
+        if keyVariable not in os.environ:
+            try:
+                os.unlink(keyPath)
+            except OSError:
+                pass
+
+def connect():
+    # A proxy for the running service, or None if there isn't one we can trust
+    key = readKey()
+    if key is None:
+        return None
+    manager = ServiceManager(address=address, authkey=key)
+    try:
+        manager.connect()
+        return manager.getService()
+    except (OSError, AuthenticationError):
+        return None
+
+def solveJob(job, service=None):
+    service = service or connect()
+    return service.solve(job) if service is not None else hungerBatch.solveJob(job)
+
+def solveBatch(jobs, workers=None, service=None):
+    # Like hungerBatch.solveBatch, through the service if there is one
+    service = service or connect()
+    if service is None:
+        yield from hungerBatch.solveBatch(jobs, workers)
+    else:
+        yield from service.solveBatch(list(jobs))
+
+if __name__ == '__main__':
+    import sys
+
+    scales = sys.argv[1:] or [h.scale]
+    print("Serving {} on {}:{}".format(", ".join(scales), *address))
+    try:
+        serve(scales)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,84 @@
+# Sharing datasets with worker processes
+#
+# Rather than have every worker load (or under spawn, re-parse) each scale itself, the parent publishes a scale's
+# arrays - region metrics, names, the CSR adjacency and the distance matrix, if there is one - into
+# multiprocessing.shared_memory blocks once. Workers attach read-only numpy views onto the same memory, and build their
+# Dataset on top of them, so there's only ever one copy however big the pool gets.
+#
+# publish returns a small picklable handle (block names, shapes and dtypes) to hand to the workers - usually through
+# Pool(initializer=attachAll, initargs=(handles,)). The parent owns the blocks, and should unpublish when it's done.
+
+import numpy as np
+from multiprocessing import shared_memory
+import hungerDataStructs as ds
+import hungerDistances
+
+# The blocks this process has made or attached, by scale - these have to be kept alive as long as the views are
+blocks = {}
+
+def publish(scale=None):
+    scale = scale or ds.scale
+    if scale in blocks:
+        return getHandle(scale)
+
+    dataset = ds.getDataset(scale)
+    arrays = dict(dataset.arrays)
+    if isinstance(dataset.distances, hungerDistances.DistanceMatrix):
+        arrays["distances"] = dataset.distances.matrix
+
+    blocks[scale] = {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        blocks[scale][name] = (block, array.shape, array.dtype.str)
+    return getHandle(scale)
+
+def getHandle(scale):
+    return (scale, { name: (block.name, shape, dtype) for name, (block, shape, dtype) in blocks[scale].items() })
+
+def attach(handle):
+    # Build this process' dataset for the scale on top of the published arrays
+    scale, arrays = handle
+    if scale in ds.datasets:
+        return ds.datasets[scale]
+
+    blocks[scale] = {}
+    views = {}
+    for name, (blockName, shape, dtype) in arrays.items():
+        block = openBlock(blockName)
+        blocks[scale][name] = (block, shape, dtype)
+        view = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+        view.flags.writeable = False
+        views[name] = view
+
+    distances = views.pop("distances", None)
+    codes = views["codes"].tolist()
+    distances = None if distances is None else hungerDistances.DistanceMatrix(distances, codes)
+    ds.datasets[scale] = ds.Dataset(scale, views, distances)
+    return ds.datasets[scale]
+
+def attachAll(handles):
+    for handle in handles:
+        attach(handle)
+
+def openBlock(name):
+    # Attach without the resource tracker thinking this process owns the block - otherwise it'd get unlinked (and
+    # warned about) when the worker exits, out from under everyone else
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before 3.13 there's no way to ask, so keep it from being registered in the first place
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None if rtype == "shared_memory" else register(name, rtype)
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+def unpublish(scale=None):
+    scale = scale or ds.scale
+    for block, _, _ in blocks.pop(scale, {}).values():
+        block.close()
+        block.unlink()
@@ -1,4 +1,6 @@
 from hungerDataStructs import *
+# These come from the default dataset, and use the code-keyed districts
+from hungerDataStructs import CodeDistrict as District, regionlist, allowed
 
 from datetime import datetime as dt
 import os
@@ -1,4 +1,6 @@
 import hunger as h
+import hungerService
+import numpy as np
 
 # Helpers ----------------------------------------------------------------------------------
 
@@ -12,15 +14,30 @@ district_color_map = {
     "4": "#B3DF8A",
     "5": "#1C7638"}
 
-with open("assets/" + h.scale + "/geo.json", encoding='utf8') as file:
-    geojson = json.load(file)
-
-def getMapFor(state = None, title=None):
+# The map shapes for each scale, loaded as they're needed
+geojsons = {}
+
+def getGeoJson(scale):
+    if scale not in geojsons:
+        with open("assets/" + scale + "/geo.json", encoding='utf8') as file:
+            geojson = json.load(file)
+        # The county shapes are keyed by their state and county FIPS codes, rather than having an id
+        for feature in geojson["features"]:
+            if "id" not in feature:
+                feature["id"] = feature["properties"]["STATE"] + feature["properties"]["COUNTY"]
+        geojsons[scale] = geojson
+    return geojsons[scale]
+
+def getMetricOptions(scale):
+    data = h.getDataset(scale)
+    return [{'label': metric + (" (broken)" if metric in data.broken else ""), 'value': metric} for metric in data.metrics]
+
+def getMapFor(state = None, title=None, scale=None):
     if state == None:
         state = h.Solver.getDummyDataFrame()
 
     fig = px.choropleth(state,
-                    geojson = geojson,
+                    geojson = getGeoJson(scale or h.scale),
                     locations='code', hover_data=['region','metric','district'],
                     color='district',
                     scope="usa",
@@ -52,11 +69,16 @@ from flask import request
 
 # initialize the solver
 solvers = {}
+# Plans the solver service came back with, for users who solved through it - shown until they reset
+served = {}
+# How long the solve button is allowed to hold up a request for, in seconds
+solveBudget = 10
 
 # make the app GUI
 app = dash.Dash(__name__)
 app.layout = html.Div([
     dcc.Store(id='solution'),
+    dcc.Store(id='solution-scale'),
     html.Div(id='ticker', children=False, style={'display': 'none'}),
 
     # Interface
@@ -67,11 +89,21 @@ app.layout = html.Div([
         html.Button("Step", id='step'),
         html.Button("Reset", id='reset'),
 
+        # The dropdown to pick the scale
+        dcc.Dropdown(
+            id='scale-drop',
+            options=[{'label': scale, 'value': scale} for scale in h.scales],
+            value=h.scale,
+            clearable=False,
+            style={
+                'width': '20%'
+            }
+        ),
         # The dropdown to pick metrics
         dcc.Dropdown(
             id='metric-drop',
-            options=[{'label': metric + (" (broken)" if metric in h.broken else ""), 'value': metric} for metric in h.metrics],
-            value=h.allowed[0],
+            options=getMetricOptions(h.scale),
+            value=h.getDataset().allowed[0],
             clearable=False,
             style={
                 'width': '40%'
@@ -106,12 +138,21 @@ app.layout = html.Div([
 @app.callback([Output('map',        'figure'),
                Output('pie-chart',  'figure'),
                Output('ticker',     'children')],
-              [Input('solution',    'data')])
-def drawCharts(solution):
-    return getMapFor(solution), getChartFor(solution), True
+              [Input('solution',    'data')],
+              [State('solution-scale', 'data')])
+def drawCharts(solution, scale):
+    return getMapFor(solution, scale=scale), getChartFor(solution), True
+
+# Callback to swap out the metrics when the scale changes
+@app.callback([Output('metric-drop', 'options'),
+               Output('metric-drop', 'value')],
+              [Input('scale-drop',   'value')])
+def updateMetrics(scale):
+    return getMetricOptions(scale), h.getDataset(scale).allowed[0]
 
 # Monolithic callback to do map updates and respond to button presses
 @app.callback([Output('solution',   'data'),
+               Output('solution-scale', 'data'),
                Output('solve',      'disabled'),
                Output('pause',      'disabled'),
                Output('step',       'disabled')],
@@ -120,22 +161,23 @@ def drawCharts(solution):
                Input('pause',       'n_clicks'),
                Input('step',        'n_clicks'),
                Input('reset',       'n_clicks')],
-              [State('metric-drop', 'value'),
+              [State('scale-drop',  'value'),
+               State('metric-drop', 'value'),
                State('count-drop',  'value')])
-def solveStepwise(tick, solveClicks, pauseClicks, stepClicks, resetClicks, metric, count):
+def solveStepwise(tick, solveClicks, pauseClicks, stepClicks, resetClicks, scale, metric, count):
     # Initialize the data
     ctx = dash.callback_context.triggered[0]['prop_id'].split('.')[0]
     paused = pauseClicks % 2 == 0
-    broken = metric in h.broken
 
     # Initialize the unique solver for this user
     ip = request.remote_addr
     if ip not in solvers:
-        solvers[ip] = h.Solver(metric, count)
+        solvers[ip] = h.Solver(metric, count, scale)
     s = solvers[ip]
+    broken = metric in s.data.broken
 
     # Ignore overflowed messages when we're solved or if one of the broken options was picked
-    if ctx not in ['reset','pause'] and (s.isSolved() or broken):
+    if ctx not in ['reset','pause'] and (s.isSolved() or broken or ip in served):
         print("Ignoring overflow message ({})".format(ctx))
         raise dash.exceptions.PreventUpdate()
 
@@ -153,19 +195,30 @@ def solveStepwise(tick, solveClicks, pauseClicks, stepClicks, resetClicks, metri
 
     # If the user pressed the reset button, reset the solver with the provided metric
     elif ctx == 'reset':
-        print("Reset the map with metric {}".format(metric))
-        s.reset(metric, count)
+        print("Reset the map with metric {} ({})".format(metric, scale))
+        s.reset(metric, count, scale)
+        served.pop(ip, None)
+        broken = metric in s.data.broken
 
-    # If the user pressed the solve button, insta-solve!
+    # If the user pressed the solve button, insta-solve! (or as close as we can get in solveBudget seconds)
     elif ctx == 'solve':
         print("Rapid-solving")
-        s.solve()
+        # Hand it to the solver service if one's running, since it has everything warm already
+        service = hungerService.connect()
+        if service is None:
+            s.solve(timeBudget=solveBudget)
+        else:
+            job = dict(metric=s.metricID, count=len(s.districts), scale=s.data.scale, seed=s.seed, timeBudget=solveBudget)
+            served[ip] = s.getDataFrameFor(np.frombuffer(service.solve(job)["placement"], dtype=np.int16))
 
     # If the user pressed the pause button, just log it
     elif ctx == 'pause':
         if paused:      print("Paused")
         else:           print("Resumed")
 
-    shouldBlockStep = broken or s.isSolved()
+    shouldBlockStep = broken or s.isSolved() or ip in served
 
-    return s.getCurrentDataFrame(), shouldBlockStep, paused and shouldBlockStep, not paused or shouldBlockStep
\ No newline at end of file
+    # If a solve ran out of time, show the best it managed
+    if ip in served:
+        return served[ip], s.data.scale, shouldBlockStep, paused and shouldBlockStep, not paused or shouldBlockStep
+    return s.getCurrentDataFrame(best=ctx == 'solve'), s.data.scale, shouldBlockStep, paused and shouldBlockStep, not paused or shouldBlockStep
\ No newline at end of file
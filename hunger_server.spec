@@ -7,7 +7,7 @@ a = Analysis(['hunger_server.py'],
              pathex=['C:\\Users\\abbyc\\Documents\\hunger_solver'],
              binaries=[],
              datas=[],
-             hiddenimports=[],
+             hiddenimports=['assets.states.name_to_abbrev', 'assets.counties.name_to_abbrev'],
              hookspath=[],
              runtime_hooks=[],
              excludes=[],
@@ -1,7 +1,11 @@
 import hunger as h
 import hunger_old as ho
 import hunger_gui as hg
+import hungerBatch as hb
+import hungerService as hsv
 from multiprocessing import Pool
+from datetime import date
+import os
 import cProfile
 import pstats
 
@@ -108,7 +112,7 @@ def timeTrial(start=1, end=6):
     stddevs = [0,0]
     fails = [0,0]
     for count in range(start, end+1):
-        for metric in h.allowed:
+        for metric in h.getDataset().allowed:
             print(" --------------- {} {} --------------- ".format(count, metric))
             hs, hos = solveParallel(metric, count)
 
@@ -130,29 +134,38 @@ def timeTrial(start=1, end=6):
 
 def unitTest(start=1, end=6, doStatus=True, doLogging=False):
     tests = map(h.Solver.solve,
-                ( h.Solver(metric, count) for metric in h.allowed for count in range(start, end+1) ), 
-                [ doStatus ] * len(h.allowed) * (end + 1 - start), 
-                [ doLogging ] * len(h.allowed) * (end + 1 - start))
+                ( h.Solver(metric, count) for metric in h.getDataset().allowed for count in range(start, end+1) ), 
+                [ doStatus ] * len(h.getDataset().allowed) * (end + 1 - start), 
+                [ doLogging ] * len(h.getDataset().allowed) * (end + 1 - start))
     for solver in tests:
         solver.printSummary()
 
-def threadUnitTest(start=1, end=6):
-    pool = Pool()
-    threadqueue = pool.map(h.Solver.solve, ( h.Solver(metric, count) for metric in h.allowed for count in range(start, end+1) ))
-    pool.close()
-    pool.join()
+def churnTest(count=400):
+    # Makes and drops lots of solvers, fresh and resumed from snapshots, printing as it goes - solvers that are never
+    # freed never clean up after themselves, and pile up wrappers on stdout until printing blows the stack
+    for i in range(count):
+        solver = h.Solver(i % 6, 2 + i % 4).solve(maxSteps=20)
+        h.Solver.fromSnapshot(solver.getSnapshot()).solve()
+        if i % 50 == 0:
+            print("{} solvers".format(2 * (i + 1)))
+    print("Made and dropped {} solvers".format(2 * count))
 
-    for solver in threadqueue:
-        solver.printSummary()
+def threadUnitTest(start=1, end=6):
+    results = []
+    # Through the solver service, if one's running
+    for result in hsv.solveBatch(hb.getSweepJobs(counts=range(start, end+1))):
+        hb.printSummary(result)
+        results.append(result)
     
-    return threadqueue
+    return results
 
 def threadUnitTestLogging(start=1, end=6):
     threadqueue = threadUnitTest(start, end)
     
-    result = { metric: [] for metric in h.allowed }
-    for solver in threadqueue:
-        result[solver.metric].append(solver.getTimeSinceStarted())
+    result = { metric: [] for metric in h.getDataset().allowed }
+    for summary in sorted(threadqueue, key=lambda summary: summary["count"]):
+        result[summary["metric"]].append(summary["time"])
+    count = end + 1 - start
     
     # Write to file
     i = 0
@@ -166,7 +179,7 @@ def threadUnitTestLogging(start=1, end=6):
     intFmt = " | ".join(["{:^9}"]*count)+"\n"
     floatFmt = " | ".join(["{:^9.3f}"]*count)+"\n"
     with open(filename, "w", encoding='utf8') as log:
-        log.write((metricFmt.format("") + intFmt.format(*range(1,count + 1))))
+        log.write((metricFmt.format("") + intFmt.format(*range(start, end + 1))))
         for metric, values in result.items():
             log.write((metricFmt.format(metric) + floatFmt.format(*values)))
 